@@ -8,10 +8,16 @@ import json
 import os
 import time
 import re
+import logging
 from datetime import datetime
 from typing import List, Dict, Tuple, Optional
 import threading
 
+# 关键词提取时视为分隔符的标点（连续多个只替换一次）
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]+')
+
+log = logging.getLogger('knowledge_manager')
+
 
 class LocalKnowledgeManager:
     """本地知识库管理器 - 优化版本"""
@@ -19,6 +25,12 @@ class LocalKnowledgeManager:
     def __init__(self, db_path="/home/orangepi/program/LTChat_updater/app/test1/knowledge.db"):
         self.db_path = db_path
         self.lock = threading.Lock()  # 添加线程锁
+        
+        # 统计信息缓存：短时间内重复查询直接返回，写入后由写路径刷新
+        self.stats_cache_ttl = 1.0
+        self._stats_cache = None
+        self._stats_cache_time = 0.0
+        
         self.init_database()
         
         # 问题类型关键词映射
@@ -57,6 +69,9 @@ class LocalKnowledgeManager:
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_category ON knowledge(category)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_content ON knowledge(content)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_relevance ON knowledge(relevance_score)')
+                # 按设备和类别取最新一条（上传页面回显已有内容）
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_device_category_time '
+                               'ON knowledge(device_id, category, updated_at DESC)')
                 
                 conn.commit()
                 conn.close()
@@ -74,6 +89,7 @@ class LocalKnowledgeManager:
             try:
                 conn = sqlite3.connect(self.db_path, timeout=timeout)
                 conn.execute('PRAGMA journal_mode=WAL')  # 启用WAL模式提高并发性能
+                conn.execute('PRAGMA synchronous=NORMAL')  # WAL下提交时不再fsync，检查点时统一落盘
                 return conn
             except sqlite3.OperationalError as e:
                 if "database is locked" in str(e) and attempt < max_retries - 1:
@@ -86,6 +102,18 @@ class LocalKnowledgeManager:
     
     def add_knowledge(self, school_info="", history="", celebrities="", device_id=""):
         """添加知识到本地库"""
+        return self.bulk_add([{
+            'school_info': school_info,
+            'history': history,
+            'celebrities': celebrities,
+            'device_id': device_id
+        }])[0]
+    
+    def bulk_add(self, entries):
+        """批量添加知识：所有条目在同一事务中写入，只提交一次
+        
+        entries 为 add_knowledge 参数字典组成的列表，返回对应的成功标志列表
+        """
         try:
             # 使用锁保护写操作
             with self.lock:
@@ -94,56 +122,63 @@ class LocalKnowledgeManager:
                     raise Exception("无法获取数据库连接")
                 
                 cursor = conn.cursor()
-                
-                knowledge_items = []
-                if school_info.strip():
-                    keywords = self._extract_keywords_enhanced(school_info)
-                    knowledge_items.append(("school_info", school_info, keywords))
-                    print(f"添加学校信息: {school_info[:50]}...")  # 调试信息
-                if history.strip():
-                    keywords = self._extract_keywords_enhanced(history)
-                    knowledge_items.append(("history", history, keywords))
-                    print(f"添加历史信息: {history[:50]}...")  # 调试信息
-                if celebrities.strip():
-                    keywords = self._extract_keywords_enhanced(celebrities)
-                    knowledge_items.append(("celebrities", celebrities, keywords))
-                    print(f"添加校友信息: {celebrities[:50]}...")  # 调试信息
-                else:
-                    print(f"校友信息为空或只有空格: '{celebrities}'")  # 调试信息
-                
-                print(f"总共要添加的知识项数: {len(knowledge_items)}")  # 调试信息
-                
-                for category, content, keywords in knowledge_items:
-                    cursor.execute('''
-                        SELECT id FROM knowledge 
-                        WHERE category = ? AND device_id = ?
-                    ''', (category, device_id))
-                    
-                    existing = cursor.fetchone()
-                    
-                    if existing:
-                        cursor.execute('''
-                            UPDATE knowledge 
-                            SET content = ?, keywords = ?, updated_at = ?, relevance_score = ?
-                            WHERE id = ?
-                        ''', (content, keywords, datetime.now(), 1.0, existing[0]))
-                        print(f"📝 更新知识: {category}")
-                    else:
-                        cursor.execute('''
-                            INSERT INTO knowledge 
-                            (category, content, keywords, device_id, created_at, updated_at, relevance_score) 
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (category, content, keywords, device_id, datetime.now(), datetime.now(), 1.0))
-                        print(f"➕ 新增知识: {category}")
-                
+                results = [self._write_knowledge(cursor, **entry) > 0 for entry in entries]
                 conn.commit()
+                
+                # 复用本次连接刷新统计缓存，上传后查询总数无需再扫表
+                self._set_stats_cache(self._query_stats(cursor))
                 conn.close()
                 
-                return len(knowledge_items) > 0
+                return results
                 
         except Exception as e:
             print(f"❌ 添加知识失败: {e}")
-            return False
+            return [False] * len(entries)
+    
+    def _write_knowledge(self, cursor, school_info="", history="", celebrities="", device_id=""):
+        """在当前事务中写入一组知识（不提交），返回写入的条目数"""
+        knowledge_items = []
+        if school_info.strip():
+            keywords = self._extract_keywords_enhanced(school_info)
+            knowledge_items.append(("school_info", school_info, keywords))
+            log.debug("添加学校信息: %s...", school_info[:50])
+        if history.strip():
+            keywords = self._extract_keywords_enhanced(history)
+            knowledge_items.append(("history", history, keywords))
+            log.debug("添加历史信息: %s...", history[:50])
+        if celebrities.strip():
+            keywords = self._extract_keywords_enhanced(celebrities)
+            knowledge_items.append(("celebrities", celebrities, keywords))
+            log.debug("添加校友信息: %s...", celebrities[:50])
+        else:
+            log.debug("校友信息为空或只有空格: %r", celebrities)
+        
+        log.debug("总共要添加的知识项数: %d", len(knowledge_items))
+        
+        for category, content, keywords in knowledge_items:
+            cursor.execute('''
+                SELECT id FROM knowledge 
+                WHERE category = ? AND device_id = ?
+            ''', (category, device_id))
+            
+            existing = cursor.fetchone()
+            
+            if existing:
+                cursor.execute('''
+                    UPDATE knowledge 
+                    SET content = ?, keywords = ?, updated_at = ?, relevance_score = ?
+                    WHERE id = ?
+                ''', (content, keywords, datetime.now(), 1.0, existing[0]))
+                log.debug("📝 更新知识: %s", category)
+            else:
+                cursor.execute('''
+                    INSERT INTO knowledge 
+                    (category, content, keywords, device_id, created_at, updated_at, relevance_score) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (category, content, keywords, device_id, datetime.now(), datetime.now(), 1.0))
+                log.debug("➕ 新增知识: %s", category)
+        
+        return len(knowledge_items)
     
     def search_knowledge(self, query, max_results=5):
         """智能搜索本地知识库"""
@@ -328,31 +363,45 @@ class LocalKnowledgeManager:
             print(f"❌ 获取分类知识失败: {e}")
             return {}
     
+    def _query_stats(self, cursor):
+        """查询各分类条数及总数"""
+        cursor.execute('''
+            SELECT category, COUNT(*) as count 
+            FROM knowledge 
+            GROUP BY category
+        ''')
+        
+        stats = {}
+        for category, count in cursor.fetchall():
+            stats[category] = count
+        
+        cursor.execute('SELECT COUNT(*) FROM knowledge')
+        total = cursor.fetchone()[0]
+        stats['total'] = total
+        return stats
+    
+    def _set_stats_cache(self, stats):
+        """更新统计缓存，传入 None 表示失效"""
+        self._stats_cache = stats
+        self._stats_cache_time = time.monotonic()
+    
     def get_knowledge_stats(self):
         """获取知识库统计信息"""
+        cached = self._stats_cache
+        if cached is not None and time.monotonic() - self._stats_cache_time < self.stats_cache_ttl:
+            return dict(cached)
+        
         try:
             conn = self._get_db_connection()
             if not conn:
                 return {"total": 0}
             
             cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT category, COUNT(*) as count 
-                FROM knowledge 
-                GROUP BY category
-            ''')
-            
-            stats = {}
-            for category, count in cursor.fetchall():
-                stats[category] = count
-            
-            cursor.execute('SELECT COUNT(*) FROM knowledge')
-            total = cursor.fetchone()[0]
-            stats['total'] = total
-            
+            stats = self._query_stats(cursor)
             conn.close()
-            return stats
+            
+            self._set_stats_cache(stats)
+            return dict(stats)
             
         except Exception as e:
             print(f"❌ 获取统计信息失败: {e}")
@@ -371,6 +420,7 @@ class LocalKnowledgeManager:
                 cursor.execute('DELETE FROM knowledge')
                 conn.commit()
                 conn.close()
+                self._set_stats_cache(None)
             print("🗑️ 知识库已清空")
             return True
         except Exception as e:
@@ -383,7 +433,7 @@ class LocalKnowledgeManager:
             return ""
         
         # 移除标点符号
-        text = re.sub(r'[^\w\s]', ' ', text)
+        text = PUNCTUATION_PATTERN.sub(' ', text)
         
         # 分词
         words = []
@@ -4,6 +4,9 @@
  */
 
 document.addEventListener('DOMContentLoaded', function() {
+    // 设备信息
+    loadDeviceInfo();
+    
     // 知识表单提交处理
     setupKnowledgeForm();
     
@@ -14,6 +17,22 @@ document.addEventListener('DOMContentLoaded', function() {
     setupFileUpload();
 });
 
+/**
+ * 加载设备信息（页面本身可缓存，设备信息单独获取）
+ */
+function loadDeviceInfo() {
+    fetch('/api/device')
+        .then(response => response.json())
+        .then(data => {
+            document.getElementById('device-hostname').textContent = data.hostname;
+            document.getElementById('device-ip').textContent = data.ip;
+            document.getElementById('device-mac').textContent = data.mac;
+        })
+        .catch(error => {
+            console.error('加载设备信息失败:', error);
+        });
+}
+
 /**
  * 设置知识表单提交处理
  */
@@ -64,7 +83,7 @@ function setupKnowledgeForm() {
             .then(data => {
                 if (data.success) {
                     statusDiv.className = 'status success';
-                    statusDiv.textContent = '✅ ' + data.message;
+                    statusDiv.textContent = (data.pending ? '⏳ ' : '✅ ') + data.message;
                 } else {
                     statusDiv.className = 'status error';
                     statusDiv.textContent = '❌ ' + data.message;
@@ -195,15 +214,23 @@ function setupFileUpload() {
             return;
         }
         
-        let html = '<strong>已选择的文件:</strong><br>';
+        // 在文档片段中构建列表，最后一次性替换，只触发一次重排
+        const fragment = document.createDocumentFragment();
+        const title = document.createElement('strong');
+        title.textContent = '已选择的文件:';
+        fragment.appendChild(title);
+        fragment.appendChild(document.createElement('br'));
         files.forEach(file => {
-            const size = file.size < 1024 * 1024 ? 
-                (file.size / 1024).toFixed(1) + ' KB' : 
+            const size = file.size < 1024 * 1024 ?
+                (file.size / 1024).toFixed(1) + ' KB' :
                 (file.size / (1024 * 1024)).toFixed(1) + ' MB';
-            html += `<div class="file-item">📄 ${file.name} (${size})</div>`;
+            const item = document.createElement('div');
+            item.className = 'file-item';
+            item.textContent = `📄 ${file.name} (${size})`;  // 文件名按文本显示，不作为 HTML 解析
+            fragment.appendChild(item);
         });
-        
-        fileList.innerHTML = html;
+
+        fileList.replaceChildren(fragment);
         updateUploadControls();
     });
     
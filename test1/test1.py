@@ -1673,7 +1673,7 @@ def start_upload_server():
     """启动知识库上传服务器"""
     try:
         # 导入并启动上传服务器
-        from upload_server import app
+        from upload_server import run_server
         
         # 获取实际的IP地址
         try:
@@ -1690,13 +1690,8 @@ def start_upload_server():
         print(f"🔗 然后访问：http://{actual_ip}:8080")
         print("=" * 50)
         
-        # 启动Flask服务器
-        app.run(
-            host='0.0.0.0',  # 监听所有接口
-            port=8080,       # 使用8080端口
-            debug=False,     # 生产模式
-            threaded=True    # 支持多线程
-        )
+        # 启动上传服务器（优先使用 waitress 生产服务器）
+        run_server()
     except Exception as e:
         print(f"❌ 上传服务器启动失败: {e}")
 
@@ -0,0 +1,825 @@
+# -*- coding: utf-8 -*-
+"""
+知识库文件上传的单元测试
+
+运行方式（在仓库根目录）：
+    python -m unittest discover -s test1/tests
+"""
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+# upload_server 在导入时读取配置，需先把知识库目录指向临时目录
+_TMP_ROOT = tempfile.mkdtemp(prefix='kb-test-')
+os.environ['KNOWLEDGE_BASE_DIR'] = os.path.join(_TMP_ROOT, 'kb')
+os.environ['KB_USAGE_FILE'] = os.path.join(_TMP_ROOT, 'kb.usage.json')
+os.environ['KB_USAGE_RESCAN_INTERVAL'] = '0'
+os.environ.pop('KB_USE_STATVFS', None)
+os.environ.pop('KB_DEDUP', None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+import upload_server as us  # noqa: E402
+
+KB_DIR = us.config.KNOWLEDGE_BASE_DIR
+
+
+def tearDownModule():
+    shutil.rmtree(_TMP_ROOT, ignore_errors=True)
+
+
+def reset_kb_dir():
+    """清空知识库目录并让已用空间计数重新统计"""
+    us.flush_kb_usage_file()  # 不让之前测试安排的延迟写入落在本测试中
+    shutil.rmtree(KB_DIR, ignore_errors=True)
+    os.makedirs(KB_DIR)
+    with us._kb_usage_lock:
+        us._kb_used_bytes.value = -1
+        us._kb_dir_mtime_ns.value = -1
+        us._kb_file_sizes = {}
+    us._remove_quietly(us.KB_USAGE_FILE)
+    us._remove_quietly(us.KB_USAGE_TABLE_FILE)
+
+
+def write_file(name, data):
+    path = os.path.join(KB_DIR, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class FormatBytesTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(us.format_bytes(0), '0.0 B')
+        self.assertEqual(us.format_bytes(1), '1.0 B')
+        self.assertEqual(us.format_bytes(1023), '1023.0 B')
+        self.assertEqual(us.format_bytes(1024), '1.0 KB')
+        self.assertEqual(us.format_bytes(1536), '1.5 KB')
+        self.assertEqual(us.format_bytes(10 * 1024 * 1024), '10.0 MB')
+        self.assertEqual(us.format_bytes(1 << 30), '1.0 GB')
+        self.assertEqual(us.format_bytes(1 << 40), '1.0 TB')
+
+    def test_beyond_largest_unit_stays_in_tb(self):
+        self.assertEqual(us.format_bytes(1 << 50), '1024.0 TB')
+
+    def test_accepts_float(self):
+        self.assertEqual(us.format_bytes(2048.0), '2.0 KB')
+
+
+@unittest.skipIf(us.orjson is None, '未安装 orjson')
+class OrjsonProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.json = us.app.json
+
+    def test_default_keeps_order_and_unicode(self):
+        self.assertEqual(self.json.dumps({'b': 1, 'a': '校'}), '{"b":1,"a":"校"}')
+
+    def test_sort_keys_and_indent(self):
+        self.assertEqual(self.json.dumps({'b': 1, 'a': 2}, sort_keys=True), '{"a":2,"b":1}')
+        self.assertEqual(self.json.dumps({'a': 1}, indent=2), '{\n  "a": 1\n}')
+
+    def test_ensure_ascii_false_stays_on_orjson(self):
+        with mock.patch.object(us.DefaultJSONProvider, 'dumps') as stdlib_dumps:
+            self.assertEqual(self.json.dumps([{'name': '校友'}], ensure_ascii=False), '[{"name":"校友"}]')
+        stdlib_dumps.assert_not_called()
+
+    def test_unsupported_kwargs_use_stdlib(self):
+        self.assertEqual(self.json.dumps({'a': '校'}, ensure_ascii=True), '{"a": "\\u6821"}')
+        self.assertEqual(self.json.dumps({'a': 1}, indent=4), '{\n    "a": 1\n}')
+
+
+class SanitizeFilenameTest(unittest.TestCase):
+    def test_strips_directories(self):
+        self.assertEqual(us.sanitize_filename('../../etc/passwd'), 'passwd')
+        self.assertEqual(us.sanitize_filename('C:\\Users\\a\\report.pdf'), 'report.pdf')
+
+    def test_dot_names(self):
+        self.assertEqual(us.sanitize_filename('..'), 'unnamed_file')
+        self.assertEqual(us.sanitize_filename('.'), 'unnamed_file')
+        self.assertEqual(us.sanitize_filename('.txt'), 'txt')
+        self.assertEqual(us.sanitize_filename('...hidden.md'), 'hidden.md')
+
+    def test_empty(self):
+        self.assertEqual(us.sanitize_filename(''), 'unnamed_file')
+        self.assertEqual(us.sanitize_filename(None), 'unnamed_file')
+        self.assertEqual(us.sanitize_filename('/'), 'unnamed_file')
+
+    def test_unsafe_characters_collapse(self):
+        self.assertEqual(us.sanitize_filename('a b  c?.txt'), 'a_b_c_.txt')
+        self.assertEqual(us.sanitize_filename('x<>|:*.pdf'), 'x_.pdf')
+
+    def test_keeps_cjk(self):
+        self.assertEqual(us.sanitize_filename('学校 简介.docx'), '学校_简介.docx')
+
+    def test_long_cjk_name_truncated_on_character_boundary(self):
+        name = us.sanitize_filename('校' * 200 + '.pdf')
+        self.assertLessEqual(len(name.encode('utf-8')), us.FILENAME_MAX_BYTES)
+        self.assertTrue(name.endswith('.pdf'))
+        self.assertEqual(name[:-4], '校' * len(name[:-4]))
+        # 3 字节的汉字不会被截断成半个字符
+        self.assertEqual(len(name[:-4].encode('utf-8')) % 3, 0)
+
+
+class CreateUniqueFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(dir=_TMP_ROOT)
+
+    def create(self, filename, existing=None, **kwargs):
+        fd, name = us.create_unique_file(self.dir, filename, existing, **kwargs)
+        if fd is not None:
+            os.close(fd)
+        return name
+
+    def test_free_name_used_as_is(self):
+        existing = set()
+        self.assertEqual(self.create('a.txt', existing), 'a.txt')
+        self.assertIn('a.txt', existing)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'a.txt')))
+
+    def test_known_names_skipped_with_counter(self):
+        existing = {'a.txt', 'a_1.txt'}
+        self.assertEqual(self.create('a.txt', existing), 'a_2.txt')
+
+    def test_collision_on_disk_not_overwritten(self):
+        with open(os.path.join(self.dir, 'a.txt'), 'wb') as f:
+            f.write(b'old')
+        self.assertEqual(self.create('a.txt', set()), 'a_1.txt')
+        with open(os.path.join(self.dir, 'a.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+
+    def test_random_suffix_after_repeated_collisions(self):
+        for name in ('a.txt', 'a_1.txt', 'a_2.txt'):
+            open(os.path.join(self.dir, name), 'wb').close()
+        name = self.create('a.txt', set())
+        self.assertRegex(name, r'^a_[0-9a-f]{6}\.txt$')
+
+    def test_link_from(self):
+        src = os.path.join(self.dir, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'data')
+        fd, name = us.create_unique_file(self.dir, 'b.md', set(), link_from=src)
+        self.assertIsNone(fd)
+        self.assertEqual(os.stat(os.path.join(self.dir, name)).st_ino, os.stat(src).st_ino)
+
+
+class ScanKbUsageTest(unittest.TestCase):
+    def setUp(self):
+        reset_kb_dir()
+
+    def test_counts_files_and_subdirectories(self):
+        write_file('a.txt', b'x' * 10)
+        write_file('b.txt', b'y' * 20)
+        os.makedirs(os.path.join(KB_DIR, 'sub'))
+        write_file(os.path.join('sub', 'c.txt'), b'z' * 5)
+        total, files = us.scan_kb_usage({})
+        self.assertEqual(total, 35)
+        self.assertEqual(set(files), {'a.txt', 'b.txt'})
+        self.assertEqual(files['a.txt'], (os.stat(os.path.join(KB_DIR, 'a.txt')).st_ino, 10))
+
+    def test_reuses_size_when_inode_unchanged(self):
+        write_file('a.txt', b'x' * 10)
+        _, files = us.scan_kb_usage({})
+        inode = files['a.txt'][0]
+        # 记录中的大小与实际不同：inode 一致时应沿用记录，不再 stat
+        total, files = us.scan_kb_usage({'a.txt': (inode, 999)})
+        self.assertEqual(total, 999)
+        self.assertEqual(files['a.txt'], (inode, 999))
+
+    def test_restats_replaced_file(self):
+        write_file('a.txt', b'x' * 10)
+        _, files = us.scan_kb_usage({})
+        inode = files['a.txt'][0]
+        total, files = us.scan_kb_usage({'a.txt': (inode + 1, 999)})
+        self.assertEqual(total, 10)
+        self.assertEqual(files['a.txt'], (inode, 10))
+
+    def test_hard_links_counted_once(self):
+        path = write_file('a.txt', b'x' * 10)
+        os.link(path, os.path.join(KB_DIR, 'b.txt'))
+        total, files = us.scan_kb_usage({})
+        self.assertEqual(total, 10)
+        self.assertEqual(len(files), 2)
+
+    def test_staging_and_hash_dirs_skipped(self):
+        os.makedirs(us.KB_STAGING_DIR)
+        with open(os.path.join(us.KB_STAGING_DIR, 'tmp'), 'wb') as f:
+            f.write(b'x' * 100)
+        total, _ = us.scan_kb_usage({})
+        self.assertEqual(total, 0)
+
+    def test_missing_directory(self):
+        shutil.rmtree(KB_DIR)
+        self.assertEqual(us.scan_kb_usage({}), (0, {}))
+
+
+class KbUsageFileTest(unittest.TestCase):
+    def setUp(self):
+        reset_kb_dir()
+
+    def read_saved(self):
+        with open(us.KB_USAGE_FILE, encoding='utf-8') as f:
+            return us.json.load(f)
+
+    def test_adjust_saves_after_delay(self):
+        write_file('a.txt', b'x' * 10)
+        self.assertEqual(us.get_kb_used_bytes(), 10)
+        self.assertEqual(self.read_saved()['used_bytes'], 10)
+        with mock.patch.object(us, 'KB_USAGE_SAVE_DELAY', 60):
+            with us._kb_usage_lock:
+                mtime_before = us._kb_dir_mtime()
+                write_file('b.txt', b'y' * 5)
+                us._adjust_kb_used_bytes(5, mtime_before)
+                us._adjust_kb_used_bytes(0, us._kb_dir_mtime())
+            self.assertEqual(us.get_kb_used_bytes(), 15)
+            # 累加只安排延迟写入，记录文件暂不变化
+            self.assertEqual(self.read_saved()['used_bytes'], 10)
+            us.flush_kb_usage_file()
+        self.assertIsNone(us._kb_usage_save_timer)
+        saved = self.read_saved()
+        self.assertEqual(saved['used_bytes'], 15)
+        self.assertEqual(saved['dir_mtime_ns'], us._kb_dir_mtime())
+
+    def test_count_save_keeps_table_of_other_process(self):
+        write_file('a.txt', b'x' * 10)
+        us.get_kb_used_bytes()
+        table = us._load_kb_file_sizes()
+        self.assertEqual(set(table), {'a.txt'})
+        # 模拟从未扫描过的 worker：本进程大小表为空时写计数不应清空已保存的表
+        us._kb_file_sizes = {}
+        with us._kb_usage_lock:
+            us._adjust_kb_used_bytes(0, us._kb_dir_mtime())
+        us.flush_kb_usage_file()
+        self.assertEqual(us._load_kb_file_sizes(), table)
+
+    def test_restart_trusts_saved_count(self):
+        write_file('a.txt', b'x' * 10)
+        us.get_kb_used_bytes()
+        with us._kb_usage_lock:
+            us._kb_used_bytes.value = -1
+            us._kb_file_sizes = {}
+        with mock.patch.object(us, 'scan_kb_usage', side_effect=AssertionError('不应扫描')):
+            self.assertEqual(us.get_kb_used_bytes(), 10)
+
+    def test_rescan_after_change_reuses_saved_table(self):
+        write_file('a.txt', b'x' * 10)
+        us.get_kb_used_bytes()
+        us._kb_file_sizes = {}
+        write_file('b.txt', b'y' * 5)
+        with mock.patch.object(us, 'scan_kb_usage', wraps=us.scan_kb_usage) as scan:
+            self.assertEqual(us.get_kb_used_bytes(), 15)
+        self.assertEqual(set(scan.call_args.args[0]), {'a.txt'})
+        self.assertEqual(set(us._load_kb_file_sizes()), {'a.txt', 'b.txt'})
+
+    def test_unusable_saved_files_ignored(self):
+        mtime_ns = us._kb_dir_mtime()
+        for counter, table in (('not json', '[1, 2]'),
+                               ('{"used_bytes": 5}', '{"a.txt": [1]}'),
+                               ('{"used_bytes": 5, "dir_mtime_ns": %d}' % (mtime_ns + 1), '{"a.txt": "x"}')):
+            with open(us.KB_USAGE_FILE, 'w', encoding='utf-8') as f:
+                f.write(counter)
+            with open(us.KB_USAGE_TABLE_FILE, 'w', encoding='utf-8') as f:
+                f.write(table)
+            self.assertEqual(us._load_kb_usage_file(mtime_ns), -1, counter)
+            self.assertEqual(us._load_kb_file_sizes(), {}, table)
+
+    def test_saved_count_used_only_for_matching_mtime(self):
+        with open(us.KB_USAGE_FILE, 'w', encoding='utf-8') as f:
+            f.write('{"used_bytes": 5, "dir_mtime_ns": 123}')
+        self.assertEqual(us._load_kb_usage_file(123), 5)
+        self.assertEqual(us._load_kb_usage_file(124), -1)
+        self.assertEqual(us._load_kb_usage_file(-1), -1)  # 目录不存在
+
+    def test_flush_without_pending_save_does_nothing(self):
+        us.flush_kb_usage_file()
+        self.assertFalse(os.path.exists(us.KB_USAGE_FILE))
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        reset_kb_dir()
+
+    def ino(self, name):
+        return os.stat(os.path.join(KB_DIR, name)).st_ino
+
+    def test_first_copy_registered(self):
+        path = write_file('a.txt', b'same')
+        us.dedup_saved_file(path, 4)
+        self.assertEqual(os.stat(path).st_nlink, 2)
+        self.assertEqual(len(os.listdir(us.KB_HASH_DIR)), 1)
+
+    def test_duplicate_becomes_hard_link_and_frees_space(self):
+        a = write_file('a.txt', b'same')
+        b = write_file('b.txt', b'same')
+        self.assertEqual(us.get_kb_used_bytes(), 8)
+        us.dedup_saved_file(a, 4)
+        us.dedup_saved_file(b, 4)
+        self.assertEqual(self.ino('a.txt'), self.ino('b.txt'))
+        with open(b, 'rb') as f:
+            self.assertEqual(f.read(), b'same')
+        self.assertEqual(us.get_kb_used_bytes(), 4)
+        self.assertEqual(us.scan_kb_usage({})[0], 4)
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR), [])
+
+    def test_different_content_kept(self):
+        a = write_file('a.txt', b'one')
+        b = write_file('b.txt', b'two')
+        us.dedup_saved_file(a, 3)
+        us.dedup_saved_file(b, 3)
+        self.assertNotEqual(self.ino('a.txt'), self.ino('b.txt'))
+        self.assertEqual(len(os.listdir(us.KB_HASH_DIR)), 2)
+
+    def test_replace_failure_logged_and_file_kept(self):
+        a = write_file('a.txt', b'same')
+        b = write_file('b.txt', b'same')
+        us.dedup_saved_file(a, 4)
+        inode = self.ino('b.txt')
+        with mock.patch.object(us.os, 'replace', side_effect=OSError('EXDEV')), \
+                mock.patch.object(us.log, 'warning') as warning:
+            us.dedup_saved_file(b, 4)
+        warning.assert_called_once()
+        self.assertEqual(self.ino('b.txt'), inode)
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR), [])
+
+    def test_prune_drops_entries_without_kb_file(self):
+        a = write_file('a.txt', b'one')
+        b = write_file('b.txt', b'two')
+        us.dedup_saved_file(a, 3)
+        us.dedup_saved_file(b, 3)
+        os.remove(a)
+        us.prune_hash_store()
+        remaining = os.listdir(us.KB_HASH_DIR)
+        self.assertEqual(len(remaining), 1)
+        self.assertEqual(os.stat(os.path.join(us.KB_HASH_DIR, remaining[0])).st_ino, self.ino('b.txt'))
+
+
+class UploadQuotaTest(unittest.TestCase):
+    def test_reserve_and_release(self):
+        quota = us.UploadQuota(100)
+        self.assertTrue(quota.reserve(60))
+        self.assertFalse(quota.reserve(50))
+        self.assertTrue(quota.reserve(40))
+        quota.release(60)
+        self.assertEqual(quota.available, 60)
+
+    def test_unlimited(self):
+        quota = us.UploadQuota(None)
+        self.assertTrue(quota.reserve(1 << 40))
+        quota.release(1 << 40)
+        self.assertIsNone(quota.available)
+
+
+class FailingStream(io.BytesIO):
+    """读取到指定字节数后抛出异常，模拟上传中途断开"""
+
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def readinto(self, b):
+        if self.tell() >= self.fail_after:
+            raise OSError('connection reset')
+        return super().readinto(b)
+
+
+class SaveUploadStreamTest(unittest.TestCase):
+    def setUp(self):
+        reset_kb_dir()
+
+    def save(self, stream, quota):
+        fd, name = us.create_unique_file(KB_DIR, 'f.txt', set())
+        path = os.path.join(KB_DIR, name)
+        result = us.save_upload_stream(FileStorage(stream=stream, filename='f.txt'), fd, path, quota, sync=False)
+        return path, result
+
+    def test_complete(self):
+        quota = us.UploadQuota(100)
+        path, (written, complete) = self.save(io.BytesIO(b'x' * 40), quota)
+        self.assertEqual((written, complete), (40, True))
+        self.assertEqual(quota.available, 60)
+        self.assertEqual(os.path.getsize(path), 40)
+
+    def test_out_of_quota_releases_reserved_chunks(self):
+        # 第一块预留成功，第二块超出额度：已预留的部分应归还，文件应删除
+        chunk = us.KB_COPY_CHUNK
+        available = chunk + chunk // 2
+        quota = us.UploadQuota(available)
+        path, (_, complete) = self.save(io.BytesIO(b'x' * (chunk * 2)), quota)
+        self.assertFalse(complete)
+        self.assertEqual(quota.available, available)
+        self.assertFalse(os.path.exists(path))
+
+    def test_error_mid_copy_releases_quota(self):
+        chunk = us.KB_COPY_CHUNK
+        available = chunk * 4
+        quota = us.UploadQuota(available)
+        with self.assertRaises(OSError):
+            self.save(FailingStream(b'x' * (chunk * 3), chunk), quota)
+        self.assertEqual(quota.available, available)
+        self.assertEqual(os.listdir(KB_DIR), [])
+
+    def test_over_file_limit(self):
+        quota = us.UploadQuota(1000)
+        with mock.patch.object(us.config, 'KNOWLEDGE_BASE_MAX_FILE_BYTES', 10):
+            path, (written, complete) = self.save(io.BytesIO(b'x' * 20), quota)
+        self.assertFalse(complete)
+        self.assertGreater(written, 10)
+        self.assertEqual(quota.available, 1000)
+        self.assertFalse(os.path.exists(path))
+
+
+class KbUploadRouteTest(unittest.TestCase):
+    def setUp(self):
+        reset_kb_dir()
+        self.client = us.app.test_client()
+
+    def upload(self, *files):
+        data = {'files': [(io.BytesIO(content), name) for name, content in files]}
+        return self.client.post('/kb/upload', data=data, content_type='multipart/form-data')
+
+    def kb_files(self):
+        return sorted(name for name in os.listdir(KB_DIR) if not name.startswith('.'))
+
+    def test_not_multipart_is_400(self):
+        response = self.client.post('/kb/upload', data=b'x', content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.get_json()['success'])
+
+    def test_missing_boundary_is_400(self):
+        response = self.client.post('/kb/upload', data=b'x', content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+    def test_over_quota_is_413(self):
+        with mock.patch.object(us.config, 'KNOWLEDGE_BASE_MAX_BYTES', 100):
+            response = self.upload(('a.txt', b'x' * 200))
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(response.get_json()['success'])
+        self.assertEqual(self.kb_files(), [])
+
+    def test_multiple_files(self):
+        response = self.upload(('a.txt', b'hello\n' * 10), ('b.pdf', b'%PDF-1.4 x'),
+                               ('c.exe', b'MZ'), ('d.pdf', b'not a pdf'))
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertTrue(body['success'])
+        self.assertIn('成功上传 2 个文件', body['message'])
+        self.assertIn('2 个文件失败', body['message'])
+        self.assertEqual(self.kb_files(), ['a.txt', 'b.pdf'])
+        self.assertEqual(body['usage']['used_bytes'], 60 + 10)
+        self.assertEqual(self.client.get('/kb/usage').get_json()['used_bytes'], 70)
+
+    def upload_ndjson(self, *files, accept='application/x-ndjson'):
+        """上传并读完流式响应（关闭响应时才归还上传许可），返回 (mimetype, 各行解析结果)"""
+        data = {'files': [(io.BytesIO(content), name) for name, content in files]}
+        with self.client.post('/kb/upload', data=data, content_type='multipart/form-data',
+                              headers={'Accept': accept}) as response:
+            return response.mimetype, [us.json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_ndjson_lines_per_file_then_summary(self):
+        mimetype, lines = self.upload_ndjson(('a.txt', b'hello'), ('c.exe', b'MZ'), ('b.txt', b'world!'))
+        self.assertEqual(mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 4)
+        # 校验时被拒绝的文件先输出，随后是各文件的保存结果
+        self.assertFalse(lines[0]['success'])
+        self.assertIsNone(lines[0]['name'])
+        self.assertEqual(sorted(line['name'] for line in lines[1:3]), ['a.txt', 'b.txt'])
+        self.assertTrue(all(line['success'] for line in lines[1:3]))
+        summary = lines[3]
+        self.assertTrue(summary['success'])
+        self.assertEqual(summary['usage']['used_bytes'], 11)
+        self.assertEqual(self.kb_files(), ['a.txt', 'b.txt'])
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR), [])
+
+    def test_ndjson_only_when_preferred(self):
+        mimetype, lines = self.upload_ndjson(('a.txt', b'hello'),
+                                             accept='application/json, application/x-ndjson;q=0.5')
+        self.assertEqual(mimetype, 'application/json')
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0]['success'])
+
+    def test_ndjson_releases_upload_permit(self):
+        with mock.patch.object(us, '_kb_upload_gate', threading.BoundedSemaphore(1)) as gate:
+            self.upload_ndjson(('a.txt', b'hello'))
+            self.assertTrue(gate.acquire(blocking=False))
+
+    def test_ndjson_error_reported_as_last_line(self):
+        with mock.patch.object(us, '_finish_kb_upload', side_effect=OSError('disk')), \
+                mock.patch.object(us.log, 'exception'):
+            _, lines = self.upload_ndjson(('a.txt', b'hello'))
+        self.assertTrue(lines[0]['success'])
+        self.assertFalse(lines[-1]['success'])
+        self.assertIn('disk', lines[-1]['message'])
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR), [])
+
+    def test_duplicate_names_get_suffix(self):
+        self.upload(('a.txt', b'one'))
+        self.upload(('a.txt', b'two'))
+        self.assertEqual(self.kb_files(), ['a.txt', 'a_1.txt'])
+
+    def test_files_staged_and_linked(self):
+        # 表单解析时写入暂存文件，保存时直接硬链接（依赖 KB_UPLOAD_ENDPOINT 与视图端点一致）
+        with mock.patch.object(us, 'link_staged_upload', wraps=us.link_staged_upload) as link, \
+                mock.patch.object(us, 'save_upload_stream', wraps=us.save_upload_stream) as copy:
+            self.upload(('a.txt', b'hello'), ('b.txt', b'world'))
+        self.assertEqual(link.call_count, 2)
+        copy.assert_not_called()
+        self.assertEqual(self.kb_files(), ['a.txt', 'b.txt'])
+
+    def test_usage_query_during_upload_counts_file_once(self):
+        # 文件链接进知识库目录后、计数累加前，另一个请求查询用量（目录 mtime 已变化）
+        self.assertEqual(us.get_kb_used_bytes(), 0)
+        real_create = us.create_unique_file
+        pollers = []
+
+        def create_then_poll(*args, **kwargs):
+            result = real_create(*args, **kwargs)
+            poller = threading.Thread(target=us.get_kb_used_bytes)
+            poller.start()
+            poller.join(0.2)
+            pollers.append(poller)
+            return result
+
+        with mock.patch.object(us, 'create_unique_file', create_then_poll):
+            response = self.upload(('a.txt', b'x' * 600), ('b.txt', b'y' * 400))
+        for poller in pollers:
+            poller.join()
+        self.assertEqual(len(pollers), 2)
+        self.assertEqual(response.get_json()['usage']['used_bytes'], 1000)
+        self.assertEqual(us.get_kb_used_bytes(), 1000)
+        self.assertEqual(us.scan_kb_usage({})[0], 1000)
+
+    def test_fallback_copy_is_counted(self):
+        # 暂存目录不可用时表单解析退回普通临时文件，保存时复制后再链接
+        with mock.patch.object(us, '_staged_upload_path', return_value=None):
+            response = self.upload(('a.txt', b'hello'))
+        self.assertTrue(response.get_json()['success'])
+        self.assertEqual(self.kb_files(), ['a.txt'])
+        self.assertEqual(us.get_kb_used_bytes(), 5)
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR), [])
+
+    def test_staging_files_removed(self):
+        self.upload(('a.txt', b'hello'), ('b.txt', b'world'))
+        self.assertEqual(os.listdir(us.KB_STAGING_DIR) if os.path.isdir(us.KB_STAGING_DIR) else [], [])
+
+    def test_usage_etag(self):
+        self.upload(('a.txt', b'hello'))
+        response = self.client.get('/kb/usage')
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/kb/usage', headers={'If-None-Match': etag}).status_code, 304)
+        self.upload(('b.txt', b'world'))
+        self.assertEqual(self.client.get('/kb/usage', headers={'If-None-Match': etag}).status_code, 200)
+
+
+
+class KnowledgeDbTestCase(unittest.TestCase):
+    """使用临时知识库数据库的测试"""
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp(dir=_TMP_ROOT)
+        patcher = mock.patch.object(us.knowledge_manager, 'db_path', os.path.join(self.db_dir, 'knowledge.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        us.knowledge_manager.init_database()
+        patcher = mock.patch.object(us, 'get_device_info',
+                                    return_value={'hostname': 'h', 'ip': '127.0.0.1', 'mac': 'm'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.close_reader()
+        self.addCleanup(self.close_reader)
+
+    def close_reader(self):
+        conn = getattr(us._knowledge_reader, 'conn', None)
+        if conn is not None:
+            conn.close()
+        us._knowledge_reader.conn = None
+
+    def insert(self, category, content, updated_at, device_id='h_m'):
+        conn = us.sqlite3.connect(us.knowledge_manager.db_path)
+        with conn:
+            conn.execute('INSERT INTO knowledge (category, content, device_id, updated_at) VALUES (?, ?, ?, ?)',
+                         (category, content, device_id, updated_at))
+        conn.close()
+
+
+class LatestKnowledgeTest(KnowledgeDbTestCase):
+    def test_latest_row_per_category(self):
+        self.insert('school_info', '旧简介', '2024-01-01 00:00:00')
+        self.insert('school_info', '新简介', '2024-02-01 00:00:00')
+        self.insert('history', '校史一', '2024-03-01 00:00:00')
+        self.insert('history', '校史二', '2024-03-01 00:00:00')  # 同一时间取后写入的
+        self.insert('history', '其他设备', '2025-01-01 00:00:00', device_id='other')
+        data = us.get_latest_knowledge()
+        self.assertEqual(data['school_info'], '新简介')
+        self.assertEqual(data['history'], '校史二')
+        self.assertEqual(data['celebrities'], '[]')
+
+    def test_empty_database(self):
+        self.assertEqual(us.get_latest_knowledge(), {'school_info': '', 'history': '', 'celebrities': '[]'})
+
+    def test_reader_connection_reused(self):
+        us.get_latest_knowledge()
+        conn = us._knowledge_reader.conn
+        us.get_latest_knowledge()
+        self.assertIs(us._knowledge_reader.conn, conn)
+
+    def test_query_error_reconnects_next_time(self):
+        us.get_latest_knowledge()
+        us._knowledge_reader.conn.close()  # 已关闭的连接查询时抛出 sqlite3.Error
+        self.assertEqual(us.get_latest_knowledge()['school_info'], '')
+        self.assertIsNone(us._knowledge_reader.conn)
+        self.insert('school_info', '简介', '2024-01-01 00:00:00')
+        self.assertEqual(us.get_latest_knowledge()['school_info'], '简介')
+
+
+class LatestCelebritiesTest(KnowledgeDbTestCase):
+    """首页回显校友数据：保存的格式化文本还原为 JSON 数组"""
+    def celebrities(self, content):
+        self.insert('celebrities', content, '2024-01-01 00:00:00')
+        return us.json.loads(us.get_latest_knowledge()['celebrities'])
+
+    def test_text_rebuilt_as_array(self):
+        self.assertEqual(self.celebrities('张三: 院士\n\n 李四:教授 \n\n校友代表\n\n\n\n王五: 比值 1:2'), [
+            {'name': '张三', 'description': '院士'},
+            {'name': '李四', 'description': '教授'},
+            {'name': '', 'description': '校友代表'},
+            {'name': '王五', 'description': '比值 1:2'},
+        ])
+
+    def test_stored_json_passed_through(self):
+        stored = [{'name': '张三', 'description': '院士'}]
+        self.assertEqual(self.celebrities(us.json.dumps(stored)), stored)
+
+    def test_bracket_text_that_is_not_json(self):
+        self.assertEqual(self.celebrities('[待补充]'), [{'name': '', 'description': '[待补充]'}])
+
+    def test_blank_text_gives_empty_array(self):
+        self.assertEqual(self.celebrities('\n\n  \n\n'), [])
+
+
+class KnowledgeWriterTest(unittest.TestCase):
+    def submit_with(self, bulk_add, **entry):
+        with mock.patch.object(us.knowledge_manager, 'bulk_add', side_effect=bulk_add):
+            return us.submit_knowledge(**entry)
+
+    def test_success_invalidates_index(self):
+        version = us._knowledge_version.value
+        self.assertTrue(self.submit_with(lambda entries: [True] * len(entries), history='a'))
+        self.assertEqual(us._knowledge_version.value, version + 1)
+
+    def test_failure_keeps_index(self):
+        version = us._knowledge_version.value
+        self.assertFalse(self.submit_with(lambda entries: [False] * len(entries), history='a'))
+        self.assertEqual(us._knowledge_version.value, version)
+
+    def test_writer_error_reports_failure(self):
+        def bulk_add(entries):
+            raise RuntimeError('boom')
+        with mock.patch.object(us.log, 'exception') as log_exception:
+            self.assertFalse(self.submit_with(bulk_add, history='a'))
+        log_exception.assert_called_once()
+
+    def test_queued_submissions_batched(self):
+        release = threading.Event()
+        batches = []
+
+        def bulk_add(entries):
+            batches.append([entry['history'] for entry in entries])
+            if len(batches) == 1:
+                release.wait(5)
+            return [True] * len(entries)
+
+        with mock.patch.object(us.knowledge_manager, 'bulk_add', side_effect=bulk_add):
+            results = {}
+            threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, us.submit_knowledge(history=str(i))))
+                       for i in range(4)]
+            threads[0].start()
+            while not batches:
+                time.sleep(0.01)
+            for thread in threads[1:]:
+                thread.start()
+            while us._knowledge_write_queue.qsize() < 3:
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(batches[0], ['0'])
+        self.assertEqual(sorted(batches[1]), ['1', '2', '3'])
+        self.assertEqual(results, {0: True, 1: True, 2: True, 3: True})
+
+    def test_timeout_returns_pending_and_writes_later(self):
+        release = threading.Event()
+        written = threading.Event()
+
+        def bulk_add(entries):
+            release.wait(5)
+            written.set()
+            return [True] * len(entries)
+
+        version = us._knowledge_version.value
+        with mock.patch.object(us.knowledge_manager, 'bulk_add', side_effect=bulk_add), \
+                mock.patch.object(us, 'KNOWLEDGE_WRITE_TIMEOUT', 0.05):
+            self.assertIsNone(us.submit_knowledge(history='a'))
+            release.set()
+            self.assertTrue(written.wait(5))
+            # 超时的提交写入后，写线程同样使首页缓存失效
+            deadline = time.monotonic() + 5
+            while us._knowledge_version.value == version and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(us._knowledge_version.value, version + 1)
+
+
+class UploadKnowledgeRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.client = us.app.test_client()
+        patcher = mock.patch.object(us, 'get_device_info',
+                                    return_value={'hostname': 'h', 'ip': '127.0.0.1', 'mac': 'm'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, **fields):
+        return self.client.post('/upload', data=fields)
+
+    def test_pending_when_writer_slow(self):
+        with mock.patch.object(us, 'submit_knowledge', return_value=None):
+            data = self.post(history='校史').get_json()
+        self.assertTrue(data['success'])
+        self.assertTrue(data['pending'])
+
+    def test_saved(self):
+        with mock.patch.object(us, 'submit_knowledge', return_value=True) as submit, \
+                mock.patch.object(us.knowledge_manager, 'get_knowledge_stats', return_value={'total': 3}):
+            data = self.post(history='校史').get_json()
+        self.assertTrue(data['success'])
+        self.assertNotIn('pending', data)
+        self.assertIn('3', data['message'])
+        submit.assert_called_once_with(device_id='h_m', school_info='', history='校史', celebrities='')
+
+    def test_failed(self):
+        with mock.patch.object(us, 'submit_knowledge', return_value=False):
+            data = self.post(history='校史').get_json()
+        self.assertFalse(data['success'])
+
+    def submitted(self, **fields):
+        """提交表单，返回传给 submit_knowledge 的参数（未提交时为 None）和响应数据"""
+        with mock.patch.object(us, 'submit_knowledge', return_value=True) as submit, \
+                mock.patch.object(us.knowledge_manager, 'get_knowledge_stats', return_value={'total': 1}):
+            data = self.post(**fields).get_json()
+        return (submit.call_args.kwargs if submit.called else None), data
+
+    def test_fields_stripped_and_missing_fields_empty(self):
+        entry, _ = self.submitted(school_info='  简介 \n', other='ignored')
+        self.assertEqual(entry, {'device_id': 'h_m', 'school_info': '简介', 'history': '', 'celebrities': ''})
+
+    def test_all_fields_blank_not_submitted(self):
+        entry, data = self.submitted(school_info='  ', history='', celebrities='\n')
+        self.assertIsNone(entry)
+        self.assertFalse(data['success'])
+
+    def test_celebrities_json_formatted_as_text(self):
+        celebrities = us.json.dumps([{'name': '张三', 'description': '院士'}, {'name': '李四'},
+                                     {'description': '校友'}, {'name': '', 'description': ''}, 'x'],
+                                    ensure_ascii=False)
+        entry, _ = self.submitted(celebrities=celebrities)
+        self.assertEqual(entry['celebrities'], '张三: 院士\n\n李四\n\n校友')
+
+    def test_celebrities_plain_text_kept(self):
+        entry, _ = self.submitted(celebrities='张三: 院士')
+        self.assertEqual(entry['celebrities'], '张三: 院士')
+
+    def test_empty_body_rejected_before_parsing(self):
+        with mock.patch.object(us, 'submit_knowledge') as submit:
+            response = self.client.post('/upload')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.get_json()['success'])
+        submit.assert_not_called()
+
+    def test_oversized_body_rejected_before_parsing(self):
+        with mock.patch.object(us.config, 'KNOWLEDGE_FORM_MAX_BYTES', 64), \
+                mock.patch.object(us.UploadRequest, 'form', new_callable=mock.PropertyMock) as form, \
+                mock.patch.object(us, 'submit_knowledge') as submit:
+            response = self.post(history='x' * 100)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(response.get_json()['success'])
+        form.assert_not_called()
+        submit.assert_not_called()
+
+    def test_body_at_limit_accepted(self):
+        body = 'history=' + 'x' * 56
+        with mock.patch.object(us.config, 'KNOWLEDGE_FORM_MAX_BYTES', len(body)), \
+                mock.patch.object(us, 'submit_knowledge', return_value=True), \
+                mock.patch.object(us.knowledge_manager, 'get_knowledge_stats', return_value={'total': 1}):
+            response = self.client.post('/upload', data=body,
+                                        content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_json()['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+上传服务启动器的单元测试
+
+运行方式（在仓库根目录）：
+    python -m unittest discover -s test1/tests
+"""
+import errno
+import io
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+from unittest import mock
+
+# 本进程内启动时会导入 upload_server，知识库目录同样指向临时目录
+_TMP_ROOT = tempfile.mkdtemp(prefix='kb-runner-test-')
+os.environ.setdefault('KNOWLEDGE_BASE_DIR', os.path.join(_TMP_ROOT, 'kb'))
+os.environ.setdefault('KB_USAGE_FILE', os.path.join(_TMP_ROOT, 'kb.usage.json'))
+os.environ['UPLOAD_SERVER_DEV'] = '1'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upload_server_runner as runner  # noqa: E402
+
+
+def tearDownModule():
+    shutil.rmtree(_TMP_ROOT, ignore_errors=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((runner._LOOPBACK, 0))
+        return s.getsockname()[1]
+
+
+class PortProbeTest(unittest.TestCase):
+    def test_try_connect_listening(self):
+        with socket.socket() as s:
+            s.bind((runner._LOOPBACK, 0))
+            s.listen(1)
+            self.assertTrue(runner._try_connect(runner._LOOPBACK, s.getsockname()[1], 1.0))
+
+    def test_try_connect_closed_port_returns_at_once(self):
+        start = time.monotonic()
+        self.assertFalse(runner._try_connect(runner._LOOPBACK, free_port(), 5.0))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_try_connect_socket_error_counts_as_closed(self):
+        with mock.patch.object(runner.socket, 'socket', side_effect=OSError(errno.EMFILE, 'too many open files')):
+            self.assertFalse(runner._try_connect(runner._LOOPBACK, 1, 0.1))
+
+    def test_probe_closed_with_reset(self):
+        # 探测连接以 RST 关闭：服务端读取时得到连接重置，而不是普通的 EOF
+        with socket.socket() as s:
+            s.bind((runner._LOOPBACK, 0))
+            s.listen(1)
+            self.assertTrue(runner._try_connect(runner._LOOPBACK, s.getsockname()[1], 1.0))
+            conn, _ = s.accept()
+            with conn, self.assertRaises(ConnectionResetError):
+                conn.recv(1)
+
+    def test_wait_for_port_times_out(self):
+        start = time.monotonic()
+        self.assertFalse(runner._wait_for_port(runner._LOOPBACK, free_port(), timeout=0.3))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    def test_wait_for_port_sees_late_listener(self):
+        port = free_port()
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+
+        def listen_later():
+            time.sleep(0.2)
+            listener.bind((runner._LOOPBACK, port))
+            listener.listen(1)
+
+        thread = threading.Thread(target=listen_later)
+        thread.start()
+        try:
+            self.assertTrue(runner._wait_for_port(runner._LOOPBACK, port, timeout=5.0))
+        finally:
+            thread.join()
+
+    def test_wait_for_port_stops_when_child_exits(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        start = time.monotonic()
+        self.assertFalse(runner._wait_for_port(runner._LOOPBACK, free_port(), timeout=5.0, proc=proc))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_wait_for_port_returns_on_ready_event(self):
+        ready = threading.Event()
+        threading.Timer(0.1, ready.set).start()
+        start = time.monotonic()
+        self.assertTrue(runner._wait_for_port(runner._LOOPBACK, free_port(), timeout=5.0, ready=ready))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+@unittest.skipIf(runner.fcntl is None, '无 fcntl')
+class InstanceLockTest(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp(dir=_TMP_ROOT)
+        patcher = mock.patch.object(runner.tempfile, 'gettempdir', return_value=self.lock_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(runner._release_instance_lock)
+
+    def lock_held_elsewhere(self, port):
+        """用另一个打开的文件描述（相当于另一个进程）尝试加锁"""
+        fd = os.open(os.path.join(self.lock_dir, f'upload_server-{port}.lock'), os.O_CREAT | os.O_RDWR)
+        try:
+            runner.fcntl.flock(fd, runner.fcntl.LOCK_EX | runner.fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def test_acquire_and_release(self):
+        self.assertTrue(runner._acquire_instance_lock(8080))
+        self.assertIsNotNone(runner._lock_fd)
+        self.assertFalse(os.get_inheritable(runner._lock_fd))
+        self.assertTrue(self.lock_held_elsewhere(8080))
+        runner._release_instance_lock()
+        self.assertIsNone(runner._lock_fd)
+        self.assertFalse(self.lock_held_elsewhere(8080))
+
+    def test_held_by_other_process(self):
+        fd = os.open(os.path.join(self.lock_dir, 'upload_server-8080.lock'), os.O_CREAT | os.O_RDWR)
+        self.addCleanup(os.close, fd)
+        runner.fcntl.flock(fd, runner.fcntl.LOCK_EX)
+        self.assertFalse(runner._acquire_instance_lock(8080))
+        self.assertIsNone(runner._lock_fd)
+
+    def test_locks_are_per_port(self):
+        self.assertTrue(runner._acquire_instance_lock(8080))
+        self.assertFalse(self.lock_held_elsewhere(8081))
+
+    def test_reacquire_while_held_is_noop(self):
+        self.assertTrue(runner._acquire_instance_lock(8080))
+        fd = runner._lock_fd
+        self.assertTrue(runner._acquire_instance_lock(8080))
+        self.assertEqual(runner._lock_fd, fd)
+
+    def test_unwritable_lock_dir_falls_back_to_probe(self):
+        with mock.patch.object(runner.tempfile, 'gettempdir', return_value=os.path.join(self.lock_dir, 'missing')):
+            self.assertTrue(runner._acquire_instance_lock(8080))
+        self.assertIsNone(runner._lock_fd)
+
+
+class PumpOutputTest(unittest.TestCase):
+    def pump(self, data, ready=None):
+        """把 data 写入管道后关闭写端，运行 _pump_output 直到读完，返回转发到 stdout 的字节"""
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with mock.patch.object(runner.sys, 'stdout', stdout):
+            runner._pump_output(os.fdopen(r, 'rb'), ready)
+        return stdout.buffer.getvalue()
+
+    def test_forwards_bytes_unchanged(self):
+        data = '启动\n'.encode('utf-8') + b'\xff\xfe partial line'
+        self.assertEqual(self.pump(data), data)
+
+    def test_forwards_in_small_reads(self):
+        with mock.patch.object(runner, '_PIPE_READ_SIZE', 3):
+            self.assertEqual(self.pump(b'0123456789\n'), b'0123456789\n')
+
+
+    def test_ready_on_werkzeug_and_waitress_banners(self):
+        for banner in (b' * Running on http://127.0.0.1:8080\n', b'Serving on http://0.0.0.0:8080\n'):
+            ready = threading.Event()
+            self.pump(b'log line\n' + banner, ready)
+            self.assertTrue(ready.is_set(), banner)
+
+    def test_banner_split_across_reads(self):
+        ready = threading.Event()
+        with mock.patch.object(runner, '_PIPE_READ_SIZE', 4):
+            self.pump(b'xx * Running on http://127.0.0.1:8080\n', ready)
+        self.assertTrue(ready.is_set())
+
+    def test_no_banner_not_ready(self):
+        ready = threading.Event()
+        self.pump(b'Traceback (most recent call last):\nOSError: Address already in use\n', ready)
+        self.assertFalse(ready.is_set())
+
+
+@unittest.skipIf(os.name == 'nt', '按进程组发送信号')
+class ReapTest(unittest.TestCase):
+    def spawn(self, ignore_term=False):
+        """启动一个独立会话中的子进程（_request_stop 按进程组发送信号，不能波及测试进程）"""
+        code = 'import signal, time\n'
+        if ignore_term:
+            code += 'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+        code += 'print("ok", flush=True)\ntime.sleep(30)\n'
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, start_new_session=True)
+        self.addCleanup(self.cleanup, proc)
+        proc.stdout.readline()  # 等到信号处理已设置好
+        return proc
+
+    def cleanup(self, proc):
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+    def lock_fd(self):
+        r, w = os.pipe()
+        os.close(w)
+        return r
+
+    def assertClosed(self, fd):
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_reap_kills_after_timeout_and_releases_lock(self):
+        proc = self.spawn(ignore_term=True)
+        fd = self.lock_fd()
+        runner._request_stop(proc)
+        start = time.monotonic()
+        runner._reap(proc, 0.3, fd)
+        self.assertLess(time.monotonic() - start, 3.0)
+        self.assertEqual(proc.returncode, -signal.SIGKILL)
+        self.assertClosed(fd)
+
+    def test_stop_without_wait_returns_at_once(self):
+        proc = self.spawn()
+        fd = self.lock_fd()
+        with mock.patch.object(runner, '_proc', proc), mock.patch.object(runner, '_started', True), \
+                mock.patch.object(runner, '_lock_fd', fd), mock.patch.object(runner, '_reaper', None):
+            start = time.monotonic()
+            runner.stop_upload_server(wait=False)
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertIsNone(runner._proc)
+            self.assertIsNone(runner._lock_fd)
+            reaper = runner._reaper
+            self.assertIsNotNone(reaper)
+            runner.stop_upload_server()  # 如 atexit 时再次调用：等待后台回收完成
+            self.assertFalse(reaper.is_alive())
+        self.assertEqual(proc.returncode, -signal.SIGTERM)
+        self.assertClosed(fd)
+
+
+class InProcessServerTest(unittest.TestCase):
+    def test_start_serve_and_stop(self):
+        import upload_server
+        port = free_port()
+        with mock.patch.object(upload_server, 'prime_kb_usage') as prime:
+            self.assertTrue(runner._start_in_process(runner._LOOPBACK, port))
+            try:
+                self.assertTrue(runner._wait_for_port(runner._LOOPBACK, port, timeout=5.0))
+                with urllib.request.urlopen(f'http://{runner._LOOPBACK}:{port}/kb/usage', timeout=5) as response:
+                    self.assertEqual(response.status, 200)
+            finally:
+                runner.stop_upload_server()
+        prime.assert_called_once_with()
+        self.assertIsNone(runner._server_shutdown)
+        # 停止后端口释放，可再次监听
+        for _ in range(50):
+            if not runner._try_connect(runner._LOOPBACK, port, 0.05):
+                break
+            time.sleep(0.02)
+        with socket.socket() as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((runner._LOOPBACK, port))
+
+    def test_busy_port_falls_back(self):
+        with socket.socket() as s:
+            s.bind((runner._LOOPBACK, 0))
+            s.listen(1)
+            port = s.getsockname()[1]
+            self.assertFalse(runner._start_in_process(runner._LOOPBACK, port))
+        self.assertIsNone(runner._server_shutdown)
+
+    def test_stop_before_serving(self):
+        import upload_server
+        serve, shutdown = upload_server.create_upload_server(runner._LOOPBACK, free_port())
+        shutdown()
+        serve()  # 已停止时立即返回并关闭监听套接字
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,82 +6,206 @@
 import os
 import json
 import re
-import mimetypes
+import secrets
+import hashlib
+import gzip
+import mmap
 import sqlite3
-from datetime import datetime
-from pathlib import Path
-from flask import Flask, request, render_template, jsonify, redirect, url_for, send_from_directory
-from werkzeug.utils import secure_filename
+import tempfile
+import threading
+import time
+import atexit
+import functools
+import queue
+import multiprocessing
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Blueprint, Request, Response, request, render_template, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import ImmutableMultiDict
+from werkzeug.formparser import FormDataParser, MultiPartParser
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.serving import WSGIRequestHandler, make_server
 from knowledge_manager import knowledge_manager
 import socket
-from werkzeug.utils import secure_filename
-import shutil
+
+try:
+    import brotli  # 可选依赖，未安装时仅提供 gzip
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # 可选依赖，未安装时使用标准库 json
+except ImportError:
+    orjson = None
+
+# 表单解析读缓冲（默认64KB），增大后每次上传的 read() 系统调用更少
+FORM_PARSER_BUFFER_SIZE = int(os.environ.get('FORM_PARSER_BUFFER_SIZE', str(256 * 1024)))
+
+
+class LargeBufferFormDataParser(FormDataParser):
+    """使用更大读缓冲解析 multipart 表单"""
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = MultiPartParser(
+            stream_factory=self.stream_factory,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            buffer_size=FORM_PARSER_BUFFER_SIZE,
+            cls=self.cls,
+        )
+        boundary = options.get("boundary", "").encode("ascii")
+        
+        if not boundary:
+            raise ValueError("Missing boundary")
+        
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+
+# 知识库文件上传视图的端点名（蓝图 kb 中的 upload_kb_files）
+KB_UPLOAD_ENDPOINT = 'kb.upload_kb_files'
+
+
+class UploadRequest(Request):
+    """上传服务请求类"""
+    form_data_parser_class = LargeBufferFormDataParser
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        """知识库文件上传时，表单解析直接把文件写入知识库目录下的暂存文件，
+        保存时只需建立硬链接，不再复制数据"""
+        if self.endpoint != KB_UPLOAD_ENDPOINT:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        try:
+            os.makedirs(KB_STAGING_DIR, exist_ok=True)
+            stream = tempfile.NamedTemporaryFile(dir=KB_STAGING_DIR, delete=False)
+            os.fchmod(stream.fileno(), 0o644)  # 与直接创建的知识库文件权限一致
+        except OSError:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        self.__dict__.setdefault('_staging_paths', []).append(stream.name)
+        return stream
+    
+    def detach_uploads(self):
+        """把上传文件和暂存文件交给调用方负责关闭和删除，返回暂存文件路径列表
+        
+        用于视图返回后仍要读取上传文件的响应体生成器（见 _stream_kb_upload）。
+        """
+        self.__dict__['files'] = ImmutableMultiDict()
+        return self.__dict__.pop('_staging_paths', [])
+    
+    def close(self):
+        """请求结束时删除暂存文件（已保存的文件另有硬链接，不受影响）"""
+        super().close()
+        for path in self.__dict__.pop('_staging_paths', ()):
+            _remove_quietly(path)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """使用 orjson 序列化/解析 JSON，接口与 Flask 默认实现一致"""
+    # orjson 可直接对应的 dumps 参数，其余参数（separators 等）交给标准库实现
+    ORJSON_DUMPS_KWARGS = frozenset(('sort_keys', 'indent', 'default', 'ensure_ascii'))
+    
+    def dumps(self, obj, **kwargs):
+        """sort_keys 对应 OPT_SORT_KEYS，indent=2 对应 OPT_INDENT_2；
+        不传参数时不排序键、不转义非 ASCII 字符（ensure_ascii=True 时交给标准库）"""
+        indent = kwargs.get('indent')
+        if (kwargs.keys() - self.ORJSON_DUMPS_KWARGS or indent not in (None, 0, 2)
+                or kwargs.get('ensure_ascii')):
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys'):
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        """jsonify 直接使用 orjson 输出的 bytes 作为响应体，省去 str 编解码"""
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=option),
+                                        mimetype=self.mimetype)
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# 日志：请求线程只负责入队，格式化和输出由独立线程完成，避免慢速终端阻塞请求
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(message)s'))
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_listener = None
+
+def _start_log_listener():
+    global _log_listener
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+
+def _stop_log_listener():
+    """退出前刷出队列中剩余的日志"""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+def _restart_log_listener_after_fork():
+    """gunicorn --preload 派生的 worker 不会继承输出线程，换新队列重新启动"""
+    global _log_queue
+    _log_queue = queue.Queue(-1)
+    _log_queue_handler.queue = _log_queue
+    _start_log_listener()
+
+_start_log_listener()
+atexit.register(_stop_log_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_log_listener_after_fork)
+
+log = logging.getLogger('upload_server')
+log.setLevel(logging.INFO)
+log.addHandler(_log_queue_handler)
+log.propagate = False
+
+# 开发服务器 / waitress 的访问日志同样只入队，由输出线程写出
+for _server_logger_name in ('werkzeug', 'waitress'):
+    _server_logger = logging.getLogger(_server_logger_name)
+    _server_logger.addHandler(_log_queue_handler)
+    _server_logger.propagate = False
 
 # 配置静态文件路径
 app.static_folder = 'static'
 app.template_folder = 'templates'
 
+# 静态资源长期缓存（URL 带内容哈希，文件变化后 URL 随之变化）
+STATIC_CACHE_MAX_AGE = 31536000  # 1年
 
-# 配置知识库文件存储
-KNOWLEDGE_BASE_DIR = os.environ.get('KNOWLEDGE_BASE_DIR', './data/knowledge_base')
-KNOWLEDGE_BASE_MAX_BYTES = int(os.environ.get('KNOWLEDGE_BASE_MAX_BYTES', '1073741824'))  # 1GB
-KNOWLEDGE_BASE_MAX_FILE_BYTES = int(os.environ.get('KNOWLEDGE_BASE_MAX_FILE_BYTES', '10485760'))  # 10MB
 
-# 允许的文件扩展名
-ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.md', '.markdown', '.txt'}
+def _static_file_hash(relative_path):
+    """计算静态文件内容哈希，用于生成带版本号的资源URL"""
+    try:
+        with open(os.path.join(app.static_folder, relative_path), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:8]
+    except OSError:
+        return '0'
 
-# 设置Flask最大内容长度
-app.config['MAX_CONTENT_LENGTH'] = KNOWLEDGE_BASE_MAX_FILE_BYTES
 
-def ensure_knowledge_base_dir():
-    """确保知识库目录存在"""
-    if not os.path.exists(KNOWLEDGE_BASE_DIR):
-        os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
+# 启动时计算一次，模板中以 ?v=<hash> 引用
+CSS_HASH = _static_file_hash('css/upload.css')
+JS_HASH = _static_file_hash('js/upload.js')
 
-def get_folder_size(folder_path):
-    """递归计算文件夹大小"""
-    if not os.path.exists(folder_path):
-        return 0
-    
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            try:
-                total_size += os.path.getsize(file_path)
-            except (OSError, IOError):
-                pass
-    return total_size
-
-def format_bytes(bytes_count):
-    """将字节数转换为人类可读格式"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_count < 1024.0:
-            return f"{bytes_count:.1f} {unit}"
-        bytes_count /= 1024.0
-    return f"{bytes_count:.1f} TB"
-
-def is_allowed_file(filename):
-    """检查文件扩展名是否允许"""
-    return any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS)
 
-def get_unique_filename(directory, filename):
-    """生成唯一的文件名（避免重复）"""
-    if not os.path.exists(os.path.join(directory, filename)):
-        return filename
-    
-    name, ext = os.path.splitext(filename)
-    counter = 1
-    while True:
-        new_filename = f"{name}_{counter}{ext}"
-        if not os.path.exists(os.path.join(directory, new_filename)):
-            return new_filename
-        counter += 1
+@app.after_request
+def add_static_cache_headers(response):
+    """带版本号的静态资源允许浏览器永久缓存"""
+    if request.path.startswith('/static/') and request.args.get('v'):
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_CACHE_MAX_AGE}, immutable'
+    return response
 
-# 启动时创建知识库目录
-ensure_knowledge_base_dir()
 
 # 配置管理
 class Config:
@@ -92,8 +216,11 @@ class Config:
         self.KNOWLEDGE_BASE_MAX_BYTES = int(os.environ.get('KNOWLEDGE_BASE_MAX_BYTES', '1073741824'))  # 1GB default
         self.KNOWLEDGE_BASE_MAX_FILE_BYTES = int(os.environ.get('KNOWLEDGE_BASE_MAX_FILE_BYTES', '10485760'))  # 10MB default
         
+        # 知识表单提交大小上限（纯文本，远小于文件上传）
+        self.KNOWLEDGE_FORM_MAX_BYTES = int(os.environ.get('KNOWLEDGE_FORM_MAX_BYTES', '2097152'))  # 2MB default
+        
         # 允许的文件扩展名
-        self.ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.md', '.markdown', '.txt'}
+        self.ALLOWED_EXTENSIONS = frozenset({'.pdf', '.doc', '.docx', '.md', '.markdown', '.txt'})
         
         # 确保知识库目录存在
         self.ensure_knowledge_base_dir()
@@ -102,82 +229,728 @@ class Config:
         """确保知识库目录存在"""
         try:
             os.makedirs(self.KNOWLEDGE_BASE_DIR, exist_ok=True)
-            print(f"✅ 知识库目录已准备: {self.KNOWLEDGE_BASE_DIR}")
+            log.info("✅ 知识库目录已准备: %s", self.KNOWLEDGE_BASE_DIR)
         except Exception as e:
-            print(f"❌ 创建知识库目录失败: {e}")
+            log.error("❌ 创建知识库目录失败: %s", e)
 
 # 全局配置实例
 config = Config()
 
 # 设置Flask配置
 app.config['MAX_CONTENT_LENGTH'] = config.KNOWLEDGE_BASE_MAX_FILE_BYTES
+# 前置支持 X-Sendfile 的服务器（Apache mod_xsendfile、lighttpd）时，静态文件交由其直接发送
+app.config['USE_X_SENDFILE'] = bool(os.environ.get('UPLOAD_SERVER_X_SENDFILE'))
 
 # 文件处理工具函数
-def get_folder_size(folder_path):
-    """递归计算文件夹大小"""
-    total_size = 0
-    try:
-        for dirpath, dirnames, filenames in os.walk(folder_path):
-            for filename in filenames:
-                file_path = os.path.join(dirpath, filename)
-                if os.path.isfile(file_path):
-                    total_size += os.path.getsize(file_path)
-    except Exception as e:
-        print(f"❌ 计算文件夹大小失败: {e}")
-    return total_size
+def get_folder_size(folder_path, skip_dirs=()):
+    """计算文件夹大小，skip_dirs 中的子目录不计入
+    
+    用显式栈代替递归遍历子目录，直接使用 DirEntry 缓存的 stat 结果；
+    硬链接（去重存储）的同一文件只计算一次。
+    """
+    skip_dirs = frozenset(skip_dirs)
+    seen_inodes = set()
+    total = 0
+    stack = [folder_path]
+    try:
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except FileNotFoundError:
+                continue  # 目录不存在或遍历期间被删除
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip_dirs:
+                            stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        if st.st_nlink > 1:
+                            key = (st.st_dev, st.st_ino)
+                            if key in seen_inodes:
+                                continue
+                            seen_inodes.add(key)
+                        total += st.st_size
+    except OSError as e:
+        log.error("❌ 计算文件夹大小失败: %s", e)
+        return 0
+    return total
 
-def format_bytes(bytes_value):
-    """格式化字节数为人类可读格式"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_value < 1024.0:
-            return f"{bytes_value:.1f} {unit}"
-        bytes_value /= 1024.0
-    return f"{bytes_value:.1f} TB"
+# 内容去重存储：.by-hash/<摘要> 与知识库中同内容的文件互为硬链接。
+# 同内容的文件会共用一个 inode，在知识库目录中原地修改其中一个会同时改变其他文件，
+# 因此默认关闭，设置 KB_DEDUP=1 开启
+KB_DEDUP = os.environ.get('KB_DEDUP') == '1'
+KB_HASH_DIR = os.path.join(config.KNOWLEDGE_BASE_DIR, '.by-hash')
+# 上传暂存目录：表单解析时文件直接写到这里，与知识库在同一文件系统上
+KB_STAGING_DIR = os.path.join(config.KNOWLEDGE_BASE_DIR, '.incoming')
 
-def sanitize_filename(filename):
-    """清理文件名，防止路径遍历和非法字符"""
-    if not filename:
-        return "unnamed_file"
+def saved_file_digest(file_path, limit):
+    """计算已保存文件的摘要；超过 limit 时返回 None
+    
+    以只读 mmap 映射文件并提示内核顺序预读，摘要直接读取映射的页缓存，
+    不再经用户态缓冲区复制。
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > limit:
+            return None
+        if size:  # 空文件无法映射
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                hasher.update(mm)
+    return hasher.hexdigest()
+
+def dedup_saved_file(file_path, size):
+    """计算已保存文件的摘要并去重（在后台线程中执行，不占用请求时间）
+    
+    内容未存储过时把文件登记到去重存储；已存储过时把它原子地替换为
+    指向已有文件的硬链接，并归还其占用的空间。失败（如文件系统不支持硬链接）时记录警告。
+    """
+    try:
+        digest = saved_file_digest(file_path, config.KNOWLEDGE_BASE_MAX_FILE_BYTES)
+        if digest is None:
+            return
+        hash_path = os.path.join(KB_HASH_DIR, digest)
+        os.makedirs(KB_HASH_DIR, exist_ok=True)
+        try:
+            os.link(file_path, hash_path)
+            return
+        except FileExistsError:
+            pass
+        if os.path.samefile(file_path, hash_path):
+            return
+        # 随机后缀：异常退出遗留的临时文件不会挡住之后的去重
+        tmp_path = os.path.join(KB_STAGING_DIR, f".dedup-{os.getpid()}-{secrets.token_hex(4)}")
+        os.makedirs(KB_STAGING_DIR, exist_ok=True)
+        os.link(hash_path, tmp_path)
+        # 替换和归还空间在同一把锁内完成，避免期间的重新扫描与计数调整重复扣减
+        with _kb_usage_lock:
+            mtime_before = _kb_dir_mtime()
+            try:
+                os.replace(tmp_path, file_path)
+            except OSError:
+                _remove_quietly(tmp_path)
+                raise
+            _adjust_kb_used_bytes(-size, mtime_before)
+    except OSError as e:
+        log.warning("⚠️ 文件去重失败 %s: %s", file_path, e)
+
+def prune_hash_store():
+    """删除只剩去重存储自身引用的文件（对应的知识库文件已被删除）"""
+    try:
+        with os.scandir(KB_HASH_DIR) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_nlink == 1:
+                    _remove_quietly(entry.path)
+    except OSError:
+        pass
+
+STAGING_MAX_AGE = 3600  # 秒，超过此时间的暂存文件视为异常退出遗留
+
+def prune_staging_files():
+    """删除异常退出时遗留的暂存文件"""
+    cutoff = time.time() - STAGING_MAX_AGE
+    try:
+        with os.scandir(KB_STAGING_DIR) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    _remove_quietly(entry.path)
+    except OSError:
+        pass
+
+# 知识库已用空间计数：启动后首次查询时扫描一次，之后由上传累加；
+# 目录 mtime 变化（外部增删文件）时重新扫描。
+# 计数放在共享内存中，gunicorn --preload 派生的多个 worker 共用同一份；
+# 同时保存到知识库目录旁的小文件，重启时目录未变化则不必重新扫描。
+# 上次扫描时各文件的 inode 和大小另存一个文件，重新扫描时 inode 未变的文件不再 stat
+_kb_usage_lock = multiprocessing.Lock()
+_kb_used_bytes = multiprocessing.RawValue('q', -1)  # -1 表示尚未统计
+_kb_dir_mtime_ns = multiprocessing.RawValue('q', -1)
+_kb_file_sizes = {}  # 文件名 -> (inode, 大小)，本进程最近一次扫描或读取的结果
+# 定期完整重新统计一次，纠正目录 mtime 反映不出的变化（如文件被原地改写），0 表示不做
+KB_USAGE_RESCAN_INTERVAL = float(os.environ.get('KB_USAGE_RESCAN_INTERVAL', '300'))  # 秒
+_kb_last_full_scan = multiprocessing.RawValue('d', 0.0)  # time.monotonic()
+# 放在知识库目录之外，写入时不改变知识库目录的 mtime；可用 KB_USAGE_FILE 指定到其他位置
+KB_USAGE_FILE = os.environ.get('KB_USAGE_FILE') or os.path.normpath(config.KNOWLEDGE_BASE_DIR) + '.usage.json'
+# 文件大小表只由刚扫描过的进程写入，与计数分开，避免未扫描过的 worker 写计数时把表清空
+KB_USAGE_TABLE_FILE = os.path.splitext(KB_USAGE_FILE)[0] + '.files.json'
+# 上传累加计数后延迟这么多秒再写记录文件，期间的多次累加合并为一次写入；进程退出时补写
+KB_USAGE_SAVE_DELAY = float(os.environ.get('KB_USAGE_SAVE_DELAY', '2'))  # 秒
+_kb_usage_save_timer = None  # 本进程待执行的延迟写入
+_kb_usage_save_timer_lock = threading.Lock()
+
+def _kb_dir_mtime():
+    try:
+        return os.stat(config.KNOWLEDGE_BASE_DIR).st_mtime_ns
+    except OSError:
+        return -1
+
+def _load_kb_usage_file(mtime_ns):
+    """读取上次保存的计数，记录的目录 mtime 与当前一致时返回字节数，否则返回 -1"""
+    try:
+        with open(KB_USAGE_FILE, encoding='utf-8') as f:
+            saved = json.load(f)
+        if mtime_ns >= 0 and saved['dir_mtime_ns'] == mtime_ns:
+            return int(saved['used_bytes'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return -1
+
+def _load_kb_file_sizes():
+    """读取上次扫描保存的文件大小表，读取失败时返回空表"""
+    try:
+        with open(KB_USAGE_TABLE_FILE, encoding='utf-8') as f:
+            saved = json.load(f)
+        return {name: (int(ino), int(size)) for name, (ino, size) in saved.items()}
+    except (OSError, ValueError, TypeError, AttributeError):
+        return {}
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        _remove_quietly(tmp_path)
+
+def _save_kb_usage_file():
+    """把当前计数写入 KB_USAGE_FILE（调用方需持有 _kb_usage_lock）"""
+    _write_json_atomic(KB_USAGE_FILE, {'used_bytes': _kb_used_bytes.value,
+                                       'dir_mtime_ns': _kb_dir_mtime_ns.value})
+
+def _schedule_kb_usage_save():
+    """安排一次延迟写入记录文件，已有待执行的写入时不重复安排"""
+    global _kb_usage_save_timer
+    with _kb_usage_save_timer_lock:
+        if _kb_usage_save_timer is None:
+            _kb_usage_save_timer = threading.Timer(KB_USAGE_SAVE_DELAY, flush_kb_usage_file)
+            _kb_usage_save_timer.daemon = True
+            _kb_usage_save_timer.start()
+
+def flush_kb_usage_file():
+    """立即写入记录文件，并取消待执行的延迟写入"""
+    global _kb_usage_save_timer
+    with _kb_usage_save_timer_lock:
+        timer, _kb_usage_save_timer = _kb_usage_save_timer, None
+    if timer is None:
+        return
+    timer.cancel()
+    with _kb_usage_lock:
+        _save_kb_usage_file()
+
+def _reset_kb_usage_save_timer_after_fork():
+    """派生的 worker 不会继承定时线程，清掉继承来的记录以便重新安排"""
+    global _kb_usage_save_timer, _kb_usage_save_timer_lock
+    _kb_usage_save_timer = None
+    _kb_usage_save_timer_lock = threading.Lock()
+
+atexit.register(flush_kb_usage_file)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_kb_usage_save_timer_after_fork)
+
+def scan_kb_usage(known_sizes):
+    """扫描知识库目录，返回 (已用字节数, 新的文件大小表)
+    
+    顶层文件的 inode 由 readdir 直接给出；与 known_sizes 中记录一致的文件沿用
+    记录的大小，只有新增或被替换的文件才需要 stat。硬链接的同一文件只计算一次，
+    去重存储中的文件（已清理孤立项）都是顶层文件的硬链接，不再单独统计，
+    其他子目录按 get_folder_size 统计。
+    """
+    files = {}
+    seen_inodes = set()
+    total = 0
+    try:
+        with os.scandir(config.KNOWLEDGE_BASE_DIR) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in (KB_STAGING_DIR, KB_HASH_DIR):
+                        total += get_folder_size(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                inode = entry.inode()
+                known = known_sizes.get(entry.name)
+                if known is not None and known[0] == inode:
+                    size = known[1]
+                else:
+                    size = entry.stat(follow_symlinks=False).st_size
+                files[entry.name] = (inode, size)
+                if inode not in seen_inodes:
+                    seen_inodes.add(inode)
+                    total += size
+    except FileNotFoundError:
+        return 0, {}
+    except OSError as e:
+        log.error("❌ 计算文件夹大小失败: %s", e)
+        return 0, {}
+    return total, files
+
+# 知识库位于独立分区时，可直接用整个分区的已用空间代替目录统计
+KB_USE_STATVFS = os.environ.get('KB_USE_STATVFS') == '1'
+
+def get_kb_used_bytes():
+    """获取知识库已用字节数"""
+    if KB_USE_STATVFS:
+        try:
+            st = os.statvfs(config.KNOWLEDGE_BASE_DIR)
+            return min(config.KNOWLEDGE_BASE_MAX_BYTES, (st.f_blocks - st.f_bfree) * st.f_frsize)
+        except OSError:
+            pass  # 退回计数方式
+    
+    global _kb_file_sizes
+    with _kb_usage_lock:
+        mtime_ns = _kb_dir_mtime()
+        if _kb_used_bytes.value < 0 or mtime_ns != _kb_dir_mtime_ns.value:
+            used_bytes = -1
+            if _kb_used_bytes.value < 0:
+                used_bytes = _load_kb_usage_file(mtime_ns)  # 运行中目录发生变化时不再信任记录
+            if used_bytes < 0:
+                prune_hash_store()
+                if not _kb_file_sizes:
+                    _kb_file_sizes = _load_kb_file_sizes()  # 其他进程或上次运行扫描的结果
+                used_bytes, _kb_file_sizes = scan_kb_usage(_kb_file_sizes)
+                _write_json_atomic(KB_USAGE_TABLE_FILE, _kb_file_sizes)
+            prune_staging_files()
+            _kb_used_bytes.value = used_bytes
+            _kb_dir_mtime_ns.value = mtime_ns
+            _save_kb_usage_file()
+        
+        if KB_USAGE_RESCAN_INTERVAL > 0:
+            now = time.monotonic()
+            if not _kb_last_full_scan.value:
+                _kb_last_full_scan.value = now
+            elif now - _kb_last_full_scan.value >= KB_USAGE_RESCAN_INTERVAL:
+                _kb_last_full_scan.value = now
+                _kb_post_pool.submit(rescan_kb_usage)  # 后台进行，本次仍返回当前计数
+        return _kb_used_bytes.value
+
+def rescan_kb_usage():
+    """不沿用大小表，重新 stat 所有文件得到已用空间"""
+    global _kb_file_sizes
+    with _kb_usage_lock:
+        mtime_ns = _kb_dir_mtime()
+        prune_hash_store()
+        used_bytes, _kb_file_sizes = scan_kb_usage({})
+        _write_json_atomic(KB_USAGE_TABLE_FILE, _kb_file_sizes)
+        if used_bytes != _kb_used_bytes.value:
+            log.info("🔄 知识库已用空间校正: %s -> %s", _kb_used_bytes.value, used_bytes)
+        _kb_used_bytes.value = used_bytes
+        _kb_dir_mtime_ns.value = mtime_ns
+        _save_kb_usage_file()
+
+def fs_free_bytes():
+    """知识库所在分区可供普通用户使用的剩余字节数（一次 statvfs），无法获取时返回 None"""
+    try:
+        st = os.statvfs(config.KNOWLEDGE_BASE_DIR)
+    except OSError:
+        return None
+    return st.f_bavail * st.f_frsize
+
+def _adjust_kb_used_bytes(nbytes, mtime_before):
+    """本服务改动知识库目录后调整计数（调用方需持有 _kb_usage_lock，改动本身也须在锁内完成）
+    
+    mtime_before 为改动前的目录 mtime：与记录一致时计数仍准确，累加后记录改动后的 mtime；
+    不一致说明目录另有未统计的变化，保持记录不变，下次查询时重新扫描（扫描结果已包含本次改动）。
+    """
+    if _kb_used_bytes.value >= 0 and mtime_before == _kb_dir_mtime_ns.value:
+        _kb_used_bytes.value += nbytes
+        _kb_dir_mtime_ns.value = _kb_dir_mtime()
+        _schedule_kb_usage_save()  # 热路径上不写文件
+
+def publish_kb_file(src_path, filename, existing_names, size):
+    """把暂存文件以不重名的文件名硬链接进知识库并累加已用空间，返回正式文件路径
+    
+    链接和计数调整在 _kb_usage_lock 内一起完成：并发的用量查询要么在链接之前扫描
+    （不含该文件，随后在这里累加），要么在累加之后看到已记录的目录 mtime 而不再扫描，
+    同一文件不会被计算两次。
+    """
+    with _kb_usage_lock:
+        mtime_before = _kb_dir_mtime()
+        _, unique_filename = create_unique_file(config.KNOWLEDGE_BASE_DIR, filename, existing_names,
+                                                link_from=src_path)
+        _adjust_kb_used_bytes(size, mtime_before)
+    return os.path.join(config.KNOWLEDGE_BASE_DIR, unique_filename)
+
+KB_COPY_CHUNK = int(os.environ.get('KB_COPY_CHUNK', str(1 << 20)))  # 上传文件写盘块大小，默认1MB
+
+# 复制缓冲区池：上传写盘复用固定的几块缓冲区，避免每块数据都新分配内存
+KB_BUFFER_POOL_SIZE = 8
+_kb_buffer_pool = queue.LifoQueue(maxsize=KB_BUFFER_POOL_SIZE)
+
+def get_copy_buffer():
+    """从池中取一块 KB_COPY_CHUNK 大小的缓冲区，池空时新分配"""
+    try:
+        return _kb_buffer_pool.get_nowait()
+    except queue.Empty:
+        return bytearray(KB_COPY_CHUNK)
+
+def put_copy_buffer(buf):
+    """归还缓冲区，池满时直接释放"""
+    try:
+        _kb_buffer_pool.put_nowait(buf)
+    except queue.Full:
+        pass
+
+class UploadQuota:
+    """一次上传请求内共享的剩余空间额度，多个保存线程按块预留
+    
+    available 为 None 表示额度足够（整个请求体都放得下），预留总是成功且不加锁。
+    """
     
-    # 获取安全的文件名
-    safe_filename = secure_filename(filename)
-    if not safe_filename:
-        safe_filename = "unnamed_file"
+    def __init__(self, available):
+        self.available = available
+        self.lock = threading.Lock()
     
-    # 进一步清理特殊字符
-    safe_filename = re.sub(r'[^\w\-_\.]', '_', safe_filename)
+    def reserve(self, nbytes):
+        if self.available is None:
+            return True
+        with self.lock:
+            if nbytes > self.available:
+                return False
+            self.available -= nbytes
+            return True
     
-    return safe_filename
+    def release(self, nbytes):
+        if self.available is None:
+            return
+        with self.lock:
+            self.available += nbytes
+
+def _read_full(stream, view):
+    """从流中读满 view（到达末尾时可能不满），返回读取的字节数"""
+    total = 0
+    readinto = getattr(stream, 'readinto', None)
+    while total < len(view):
+        if readinto is not None:
+            n = readinto(view[total:])
+        else:
+            data = stream.read(len(view) - total)
+            n = len(data)
+            view[total:total + n] = data
+        if not n:
+            break
+        total += n
+    return total
+
+def _write_all(fd, view):
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
 
-def get_unique_filename(directory, filename):
-    """获取唯一文件名，如果存在则添加数字后缀"""
-    base_path = Path(directory)
-    file_path = base_path / filename
+def _sync_and_drop_cache(fd):
+    """fsync 落盘后通知内核丢弃该文件的页缓存"""
+    os.fsync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+_libc = None
+
+def _syncfs(path):
+    """用 syncfs(2) 只刷写 path 所在的文件系统，平台不支持时返回 False"""
+    global _libc
+    try:
+        if _libc is None:
+            import ctypes
+            _libc = ctypes.CDLL(None, use_errno=True)
+        syncfs = _libc.syncfs
+    except (ImportError, OSError, AttributeError):
+        return False
     
-    if not file_path.exists():
-        return filename
+    import ctypes
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    finally:
+        os.close(fd)
+    return True
+
+def sync_kb_files(file_paths):
+    """批量上传写完后一次刷盘，代替逐个文件 fsync，再释放这些文件的页缓存"""
+    if _syncfs(config.KNOWLEDGE_BASE_DIR):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        for file_path in file_paths:
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        return
     
-    # 分离文件名和扩展名
-    stem = file_path.stem
-    suffix = file_path.suffix
+    for file_path in file_paths:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            _sync_and_drop_cache(fd)
+        finally:
+            os.close(fd)
+    fsync_directory(config.KNOWLEDGE_BASE_DIR)
+
+def fsync_directory(path):
+    """fsync 目录本身，使新建的文件名（目录项）也落盘"""
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _staged_upload_path(stream):
+    """上传内容在暂存目录中时返回暂存文件路径，否则返回 None"""
+    path = getattr(stream, 'name', None)
+    if isinstance(path, str) and os.path.dirname(path) == KB_STAGING_DIR:
+        return path
+    return None
+
+def link_staged_upload(stream, staged_path, filename, existing_names, quota, sync=True):
+    """把暂存文件硬链接为知识库中的正式文件，不复制数据
+    
+    返回 (正式文件路径, 文件大小, 是否成功)；超过单文件限制或额度不足时路径为 None。
+    """
+    stream.flush()
+    size = os.fstat(stream.fileno()).st_size
+    if size > config.KNOWLEDGE_BASE_MAX_FILE_BYTES or not quota.reserve(size):
+        return None, size, False
     
-    counter = 1
+    try:
+        if sync:
+            _sync_and_drop_cache(stream.fileno())
+        file_path = publish_kb_file(staged_path, filename, existing_names, size)
+    except Exception:
+        quota.release(size)
+        raise
+    return file_path, size, True
+
+def create_staging_file():
+    """在暂存目录中新建一个临时文件，返回 (文件描述符, 路径)"""
+    os.makedirs(KB_STAGING_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=KB_STAGING_DIR)
+    os.fchmod(fd, 0o644)  # 与表单解析创建的暂存文件权限一致
+    return fd, path
+
+def _preallocate(fd, size):
+    """按已知大小一次性为目标文件分配磁盘空间，减少分块追加写入产生的碎片
+    
+    平台或文件系统不支持时忽略，仍按原方式追加写入。
+    不超过一块（KB_COPY_CHUNK）的小文件只需一次 write，不再多一次 fallocate 调用。
+    """
+    if size <= KB_COPY_CHUNK or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass
+
+def _stream_remaining(stream):
+    """返回可定位流中剩余的字节数，无法得知时返回 0"""
+    try:
+        pos = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(pos)
+    except (AttributeError, OSError, ValueError):
+        return 0
+    return end - pos
+
+def save_upload_stream(file, fd, file_path, quota, sync=True):
+    """分块把上传文件写入已创建的 fd，同时累计大小并从 quota 预留空间
+    
+    上传内容通常已由表单解析写入暂存文件并直接链接（见 link_staged_upload），
+    只有暂存目录不可用时才走这里。
+    写完后 fsync 落盘并通知内核丢弃这些页缓存，避免挤占小内存设备的缓存；
+    sync=False 时由调用方在整批写完后统一刷盘（见 sync_kb_files）。
+    超过单文件限制或额度不足时停止写入、删除已写部分并归还额度。
+    返回 (已读取字节数, 是否完整写入)。
+    """
+    written = 0
+    reserved = 0
+    complete = True
+    buf = get_copy_buffer()
+    view = memoryview(buf)
+    try:
+        try:
+            size = _stream_remaining(file.stream)  # 以实际内容为准，不信任分段头中的长度
+            if size <= config.KNOWLEDGE_BASE_MAX_FILE_BYTES:
+                _preallocate(fd, size)
+            while True:
+                n = _read_full(file.stream, view)
+                if not n:
+                    break
+                written += n
+                if written > config.KNOWLEDGE_BASE_MAX_FILE_BYTES or not quota.reserve(n):
+                    complete = False
+                    break
+                reserved += n
+                _write_all(fd, view[:n])
+            
+            if complete and sync:
+                _sync_and_drop_cache(fd)
+        finally:
+            os.close(fd)
+            put_copy_buffer(buf)
+    except Exception:
+        quota.release(reserved)
+        _remove_quietly(file_path)
+        raise
+    
+    if not complete:
+        quota.release(reserved)
+        _remove_quietly(file_path)
+    return written, complete
+
+def _remove_quietly(file_path):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+# (除数, 单位) 查表，下标为 bit_length 折算的 1024 次幂
+BYTE_UNITS = tuple((1 << (i * 10), unit) for i, unit in enumerate(('B', 'KB', 'MB', 'GB', 'TB')))
+
+def format_bytes(bytes_value):
+    """格式化字节数为人类可读格式（按 bit_length 直接查表选单位）"""
+    bytes_value = int(bytes_value)
+    divisor, unit = BYTE_UNITS[min(len(BYTE_UNITS) - 1, max(0, (bytes_value.bit_length() - 1) // 10))]
+    return f"{bytes_value / divisor:.1f} {unit}"
+
+# 容量上限固定不变，启动时格式化一次
+KB_MAX_HUMAN = format_bytes(config.KNOWLEDGE_BASE_MAX_BYTES)
+KB_MAX_FILE_HUMAN = format_bytes(config.KNOWLEDGE_BASE_MAX_FILE_BYTES)
+KNOWLEDGE_FORM_MAX_HUMAN = format_bytes(config.KNOWLEDGE_FORM_MAX_BYTES)
+
+# 文件名中字母、数字（含中文等 Unicode 字符）、下划线、点和横线以外的字符
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w.\-]+')
+FILENAME_MAX_BYTES = 240  # 文件系统上限 255 字节，留出重名时数字后缀的余量
+
+@functools.lru_cache(maxsize=256)
+def sanitize_filename(filename):
+    """清理文件名，防止路径遍历和非法字符
+    
+    只保留最后一级路径，连续的非法字符替换为一个下划线，并去掉开头的点
+    （避免隐藏文件和 ".."）。与 secure_filename 不同，中文文件名保持原样。
+    结果只取决于输入，重复上传同一批文件时直接取缓存。
+    """
+    name = filename.replace('\\', '/').rsplit('/', 1)[-1] if filename else ''
+    name = UNSAFE_FILENAME_CHARS.sub('_', name).lstrip('.')
+    if not name:
+        return "unnamed_file"
+    
+    if len(name.encode('utf-8')) > FILENAME_MAX_BYTES:
+        stem, ext = os.path.splitext(name)
+        stem = stem.encode('utf-8')[:FILENAME_MAX_BYTES - len(ext.encode('utf-8'))].decode('utf-8', 'ignore')
+        name = stem + ext
+    return name
+
+def list_existing_names(directory):
+    """一次 scandir 读取目录下已有的文件名"""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name for entry in it}
+    except OSError:
+        return set()
+
+UNIQUE_NAME_RETRIES = 3  # 创建时连续遇到同名文件的次数，超过后改用随机后缀
+
+def create_unique_file(directory, filename, existing=None, link_from=None):
+    """以 O_EXCL 独占创建文件，重名时添加数字后缀
+    
+    existing 为已知存在的文件名集合（见 list_existing_names），传入时先在集合中
+    跳过重名，不必逐个尝试创建；新建的文件名会加入集合。
+    集合之外（并发上传或其他进程）连续撞名 UNIQUE_NAME_RETRIES 次后改用随机后缀，
+    不再逐个数字尝试。
+    link_from 不为空时改为创建指向该文件的硬链接，此时返回的文件描述符为 None。
+    返回 (文件描述符, 实际文件名)，检查与创建为同一步，避免并发上传互相覆盖。
+    """
+    if existing is None:
+        existing = set()
+    stem, suffix = os.path.splitext(filename)
+    
+    new_filename = filename
+    counter = 0
+    collisions = 0
     while True:
-        new_filename = f"{stem}_{counter}{suffix}"
-        new_path = base_path / new_filename
-        if not new_path.exists():
-            return new_filename
-        counter += 1
+        if new_filename not in existing:
+            try:
+                if link_from is not None:
+                    fd = None
+                    os.link(link_from, os.path.join(directory, new_filename))
+                else:
+                    fd = os.open(os.path.join(directory, new_filename), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                existing.add(new_filename)
+                return fd, new_filename
+            except FileExistsError:
+                existing.add(new_filename)
+                collisions += 1
+        if collisions >= UNIQUE_NAME_RETRIES:
+            new_filename = f"{stem}_{secrets.token_hex(3)}{suffix}"
+        else:
+            counter += 1
+            new_filename = f"{stem}_{counter}{suffix}"
 
 def is_allowed_file(filename):
     """检查文件扩展名是否被允许"""
     if not filename:
         return False
     
-    file_ext = Path(filename).suffix.lower()
+    file_ext = os.path.splitext(filename)[1].lower()
     return file_ext in config.ALLOWED_EXTENSIONS
 
 
+# 二进制文档的文件头特征；文本类文件只要求开头不含 NUL 字节
+FILE_SIGNATURES = {
+    '.pdf': (b'%PDF-',),
+    '.docx': (b'PK\x03\x04',),
+    '.doc': (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',),
+}
+TEXT_SNIFF_BYTES = 1024
+UTF16_BOMS = (b'\xff\xfe', b'\xfe\xff')
+
+def is_valid_file_content(filename, stream):
+    """读取文件开头检查内容是否与扩展名相符，读取后把流倒回原位置"""
+    file_ext = os.path.splitext(filename)[1].lower()
+    start = stream.tell()
+    try:
+        head = stream.read(TEXT_SNIFF_BYTES)
+    finally:
+        stream.seek(start)
+    
+    signatures = FILE_SIGNATURES.get(file_ext)
+    if signatures is not None:
+        return head.startswith(signatures)
+    return head.startswith(UTF16_BOMS) or b'\x00' not in head
+
+# 知识表单字段（与 knowledge_manager.add_knowledge 的参数名一致）
+KNOWLEDGE_FIELDS = ('school_info', 'history', 'celebrities')
+
+
+# 读取知识的数据库连接：每个工作线程保留一个，不必每次请求重新打开数据库
+_knowledge_reader = threading.local()
+
+def get_knowledge_connection():
+    """返回当前线程的只读查询连接，首次使用时创建"""
+    conn = getattr(_knowledge_reader, 'conn', None)
+    if conn is None:
+        db_path = knowledge_manager.db_path
+        log.debug("数据库路径: %s", db_path)
+        if not os.path.exists(db_path):
+            log.debug("数据库文件不存在: %s", db_path)
+            knowledge_manager.init_database()  # 初始化数据库
+        conn = sqlite3.connect(db_path, timeout=20.0)
+        _knowledge_reader.conn = conn
+    return conn
+
+# 一次查询取出各类别最新的一条（同一时间戳时取后写入的）
+LATEST_KNOWLEDGE_SQL = '''
+    SELECT category, content FROM (
+        SELECT category, content,
+               ROW_NUMBER() OVER (PARTITION BY category ORDER BY updated_at DESC, id DESC) AS rn
+        FROM knowledge
+        WHERE device_id = ? AND category IN ({})
+    ) WHERE rn = 1
+'''.format(', '.join('?' * len(KNOWLEDGE_FIELDS)))
+
 def get_latest_knowledge():
     """获取最新的知识库内容"""
     try:
@@ -185,96 +958,77 @@ def get_latest_knowledge():
         device_info = get_device_info()
         device_id = f"{device_info['hostname']}_{device_info['mac']}"
         
-        # 打印数据库路径以确保正确
-        db_path = knowledge_manager.db_path
-        print(f"数据库路径: {db_path}")
-        
-        # 检查数据库文件是否存在
-        if not os.path.exists(db_path):
-            print(f"数据库文件不存在: {db_path}")
-            knowledge_manager.init_database()  # 初始化数据库
-        
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
         knowledge_data = {
             'school_info': '',
             'history': '',
             'celebrities': ''
         }
         
-        # 获取每个类别的最新内容
+        try:
+            latest = dict(get_knowledge_connection().execute(LATEST_KNOWLEDGE_SQL, (device_id, *KNOWLEDGE_FIELDS)))
+        except sqlite3.Error as e:
+            log.error("查询知识库失败: %s", e)
+            _knowledge_reader.conn = None  # 下次重新连接
+            latest = {}
+        
+        # 处理每个类别的最新内容
         for category in knowledge_data.keys():
             try:
-                print(f"查询类别: {category}, 设备ID: {device_id}")
-                cursor.execute('''
-                    SELECT content FROM knowledge 
-                    WHERE category = ? AND device_id = ?
-                    ORDER BY updated_at DESC LIMIT 1
-                ''', (category, device_id))
-                
-                result = cursor.fetchone()
-                if result:
-                    content = result[0]
+                log.debug("查询类别: %s, 设备ID: %s", category, device_id)
+                content = latest.get(category)
+                if content is not None:
                     # 处理校友数据，尝试将文本转为JSON数组
                     if category == 'celebrities' and content:
                         # 对于校友数据，我们需要将其转换为JSON格式供前端使用
-                        try:
-                            # 先尝试直接解析JSON（如果已经是JSON格式）
-                            json.loads(content)
+                        # 先尝试直接解析JSON（如果已经是JSON格式）；
+                        # /upload 保存的是格式化文本，不以 [ 或 { 开头时不必尝试解析
+                        is_json = False
+                        if content.lstrip().startswith(('[', '{')):
+                            try:
+                                app.json.loads(content)
+                                is_json = True
+                            except json.JSONDecodeError:
+                                pass
+                        if is_json:
                             # 如果能解析，说明是有效的JSON，直接使用
                             knowledge_data[category] = content
-                            print(f"成功加载JSON校友数据")
-                        except json.JSONDecodeError:
-                            # 不是JSON，尝试将文本转换为结构化数据
-                            lines = content.split("\n\n")
-                            celebrities_array = []
-                            
-                            for line in lines:
-                                line = line.strip()
-                                if not line:
-                                    continue
-                                    
-                                if ':' in line:
-                                    name, desc = line.split(':', 1)
-                                    celebrities_array.append({
-                                        "name": name.strip(),
-                                        "description": desc.strip()
-                                    })
-                                else:
-                                    celebrities_array.append({
-                                        "name": "",
-                                        "description": line
-                                    })
+                            log.debug("成功加载JSON校友数据")
+                        else:
+                            # 不是JSON，尝试将文本转换为结构化数据（每段 "姓名: 描述"，没有冒号时整段为描述）
+                            celebrities_array = [
+                                {"name": name.strip(), "description": desc.strip()} if sep
+                                else {"name": "", "description": name}
+                                for name, sep, desc in (line.partition(':') for line in
+                                                        map(str.strip, content.split("\n\n")) if line)
+                            ]
                             
                             # 将结构化数据转为JSON字符串
                             if celebrities_array:
-                                knowledge_data[category] = json.dumps(celebrities_array, ensure_ascii=False)
-                                print(f"将文本转换为JSON校友数据，共 {len(celebrities_array)} 条")
+                                knowledge_data[category] = app.json.dumps(celebrities_array, ensure_ascii=False)
+                                log.debug("将文本转换为JSON校友数据，共 %d 条", len(celebrities_array))
                             else:
                                 knowledge_data[category] = "[]"
-                                print(f"校友数据为空，设置为空数组")
+                                log.debug("校友数据为空，设置为空数组")
                     else:
                         # 非校友数据，直接使用
                         knowledge_data[category] = content
                     
-                    print(f"找到已有内容: {category} -> {content[:30]}...")
+                    log.debug("找到已有内容: %s -> %s...", category, content[:30])
                 else:
-                    print(f"未找到内容: {category}")
+                    log.debug("未找到内容: %s", category)
                     # 对于校友数据，如果没有内容，设置为空数组
                     if category == 'celebrities':
                         knowledge_data[category] = "[]"
             except Exception as category_error:
-                print(f"查询类别 {category} 失败: {category_error}")
+                log.error("查询类别 %s 失败: %s", category, category_error)
                 # 对于校友数据，如果出现错误，设置为空数组
                 if category == 'celebrities':
                     knowledge_data[category] = "[]"
         
-        conn.close()
         return knowledge_data
         
     except Exception as e:
-        print(f"获取知识库内容失败: {e}")
+        log.exception("获取知识库内容失败")
         # 返回默认值，确保校友数据是空数组
         return {
             'school_info': '',
@@ -283,15 +1037,60 @@ def get_latest_knowledge():
         }
 
 # 获取设备信息
+# 热点所在网卡，用于直接读取本机IP
+DEVICE_INTERFACE = os.environ.get('DEVICE_INTERFACE', 'wlan0')
+SIOCGIFADDR = 0x8915
+
+
+def get_interface_ip(ifname=DEVICE_INTERFACE):
+    """通过 ioctl(SIOCGIFADDR) 读取网卡IP，无需外网连接；失败返回 None"""
+    try:
+        import fcntl
+        import struct
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            packed = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', ifname[:15].encode('utf-8')))
+        return socket.inet_ntoa(packed[20:24])
+    except (ImportError, OSError):
+        return None
+
+
+def get_local_ip():
+    """获取本机IP：优先读取热点网卡，其次用UDP探测默认路由；都失败返回 None"""
+    ip = get_interface_ip()
+    if ip:
+        return ip
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+# 设备信息缓存：IP 很少变化，按 TTL 重新读取
+DEVICE_INFO_TTL = float(os.environ.get('DEVICE_INFO_TTL', '60'))  # 秒
+_device_info = None
+_device_info_time = 0.0
+
+
 def get_device_info():
-    """获取设备基本信息"""
+    """获取设备基本信息（带缓存）"""
+    global _device_info, _device_info_time
+    now = time.monotonic()
+    if _device_info is None or now - _device_info_time > DEVICE_INFO_TTL:
+        _device_info = _read_device_info()
+        _device_info_time = now
+    return _device_info
+
+
+def _read_device_info():
+    """读取设备基本信息"""
     try:
         hostname = socket.gethostname()
         # 获取当前IP地址
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
+        ip = get_local_ip()
+        if not ip:
+            raise OSError("无法获取本机IP")
         # 固定使用这个MAC地址作为设备标识
         mac = '60:e9:cd:e8:cc:aa'  # 固定值，确保数据库查询一致性
         return {
@@ -312,110 +1111,224 @@ def get_device_info():
 def serve_static(filename):
     return send_from_directory(app.static_folder, filename)
 
+# 模板源码中每行的缩进和空行（换行本身保留，内联脚本不受影响）
+TEMPLATE_INDENT = re.compile(r'\n\s+')
+
+def _load_minified_template(name):
+    """读取模板并去掉缩进和空行后编译；只处理模板源码，文本框中的知识内容等动态值保持原样"""
+    source, _, _ = app.jinja_loader.get_source(app.jinja_env, name)
+    return app.jinja_env.from_string(TEMPLATE_INDENT.sub('\n', source))
+
+# 启动时预编译模板，首个请求无需再解析模板文件
+UPLOAD_TEMPLATE = _load_minified_template('upload.html')
+SUCCESS_PAGE_TEMPLATE = _load_minified_template('success.html')
+
 # 成功页面渲染
+DEFAULT_SUCCESS_MESSAGE = '知识已成功上传！'
+_success_page = None  # 默认提示语的成功页面，首次访问时渲染并压缩
+
 @app.route('/success')
 def success_page():
     """显示上传成功页面"""
-    message = request.args.get('message', '知识已成功上传！')
-    return render_template('success.html', message=message)
-
-# 成功页面模板
-SUCCESS_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>上传成功 - 校园智能小助手</title>
-    <style>
-        body { 
-            font-family: 'Microsoft YaHei', sans-serif; 
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin: 0;
-        }
-        .success-container {
-            background: white;
-            padding: 40px;
-            border-radius: 15px;
-            text-align: center;
-            box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-            max-width: 400px;
-        }
-        .success-icon { font-size: 60px; margin-bottom: 20px; }
-        h1 { color: #28a745; margin-bottom: 15px; }
-        p { color: #666; margin-bottom: 25px; line-height: 1.6; }
-        .btn { 
-            background: #4a90e2; 
-            color: white; 
-            padding: 12px 30px; 
-            text-decoration: none; 
-            border-radius: 8px; 
-            display: inline-block;
-            transition: transform 0.2s;
-        }
-        .btn:hover { transform: translateY(-2px); }
-    </style>
-</head>
-<body>
-    <div class="success-container">
-        <div class="success-icon">✅</div>
-        <h1>上传成功！</h1>
-        <p>{{ message }}</p>
-        <a href="/" class="btn">继续上传</a>
-    </div>
-</body>
-</html>
-"""
+    global _success_page
+    message = request.args.get('message', DEFAULT_SUCCESS_MESSAGE)
+    if message != DEFAULT_SUCCESS_MESSAGE:
+        return render_template(SUCCESS_PAGE_TEMPLATE, message=message)
+    
+    if _success_page is None:
+        _success_page = _build_page(render_template(SUCCESS_PAGE_TEMPLATE, message=message).encode('utf-8'))
+    return _page_response(_success_page)
 
-@app.route('/')
-def index():
-    """显示上传表单"""
-    # 获取设备信息
-    device_info = get_device_info()
+# 页面预压缩：渲染后一次性压缩，请求时按 Accept-Encoding 直接返回字节
+def _build_page(body):
+    """预压缩页面内容，返回各编码版本及ETag"""
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    return {
+        'variants': variants,
+        'etag': hashlib.sha1(body).hexdigest()
+    }
+
+
+def _page_response(page):
+    """根据客户端支持的编码返回预压缩页面"""
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in page['variants'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
     
+    response = Response(page['variants'][encoding], mimetype='text/html')
+    if encoding == 'identity':
+        response.set_etag(page['etag'])
+    else:
+        response.headers['Content-Encoding'] = encoding
+        response.set_etag(f"{page['etag']}-{encoding}")
+    response.vary.add('Accept-Encoding')
+    # 允许缓存但每次都需校验，内容未变时返回 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+# 首页渲染缓存：知识内容变化前，复用同一份渲染结果
+_index_page_lock = threading.Lock()
+_index_page = None  # {'variants': {...}, 'etag': str, 'version': int}
+# 知识内容版本号（共享内存），任一 worker 写入知识后递增，各 worker 据此重新渲染
+_knowledge_version = multiprocessing.Value('q', 0)
+
+
+def _render_index_page():
+    """渲染首页并预压缩（设备信息由页面通过 /api/device 获取）"""
     # 获取已保存的知识库内容
     try:
         form_data = get_latest_knowledge()
-        print(f"首页加载数据: {form_data}")
-        
-        # 打印具体内容信息以确认
-        for key, value in form_data.items():
-            if value:
-                print(f"{key}: {value[:50]}...")
+        # 调试级别日志：默认不输出，也不格式化内容
+        if log.isEnabledFor(logging.DEBUG):
+            for key, value in form_data.items():
+                if value:
+                    log.debug("首页加载数据 %s: %s...", key, value[:50])
     except Exception as e:
-        print(f"加载表单数据失败: {e}")
+        log.exception("加载表单数据失败")
         form_data = {
             'school_info': '',
             'history': '',
             'celebrities': ''
         }
     
-    return render_template('upload.html', 
-                        device_info=device_info, 
-                        form_data=form_data)
+    body = render_template(UPLOAD_TEMPLATE, 
+                        form_data=form_data,
+                        css_hash=CSS_HASH,
+                        js_hash=JS_HASH).encode('utf-8')
+    return _build_page(body)
+
+
+def get_index_page():
+    """获取缓存的首页，必要时重新渲染"""
+    global _index_page
+    version = _knowledge_version.value  # 先读版本号再渲染，渲染期间的更新会在下次请求时生效
+    with _index_page_lock:
+        page = _index_page
+        if page is None or page['version'] != version:
+            page = _render_index_page()
+            page['version'] = version
+            _index_page = page
+    return page
+
+
+def invalidate_index_page():
+    """知识内容更新后使首页缓存失效（对所有 worker 生效）"""
+    with _knowledge_version.get_lock():
+        _knowledge_version.value += 1
+
+
+# 知识写入合并队列：写线程忙碌期间排队的提交在同一事务中批量写入
+KNOWLEDGE_WRITE_MAX_BATCH = int(os.environ.get('KNOWLEDGE_WRITE_MAX_BATCH', 32))
+# 等待写线程提交的最长时间，超时后告知用户已在后台保存，写线程卡住时不会占住所有请求线程
+KNOWLEDGE_WRITE_TIMEOUT = float(os.environ.get('KNOWLEDGE_WRITE_TIMEOUT', '10'))  # 秒
+_knowledge_write_queue = queue.Queue()
+_knowledge_writer_lock = threading.Lock()
+_knowledge_writer = None
+
+
+def _knowledge_writer_loop():
+    """后台写线程：取出一条提交后顺带取走已排队的其余提交，一次提交事务"""
+    while True:
+        batch = [_knowledge_write_queue.get()]
+        while len(batch) < KNOWLEDGE_WRITE_MAX_BATCH:
+            try:
+                batch.append(_knowledge_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        try:
+            results = knowledge_manager.bulk_add([item['entry'] for item in batch])
+        except Exception:
+            log.exception("批量写入知识时出错")
+            results = [False] * len(batch)
+        
+        # 由写线程使首页缓存失效：等待超时的提交稍后写入时首页同样会更新
+        if any(results):
+            invalidate_index_page()
+        for item, result in zip(batch, results):
+            item['result'] = result
+            item['done'].set()
+
+
+def submit_knowledge(**entry):
+    """提交一组知识到写线程，阻塞直到其所在批次提交完成
+    
+    返回 True/False 表示写入成功或失败；超过 KNOWLEDGE_WRITE_TIMEOUT 仍未完成时返回 None，
+    该提交仍留在队列中，由写线程稍后写入。
+    """
+    global _knowledge_writer
+    with _knowledge_writer_lock:
+        if _knowledge_writer is None:
+            _knowledge_writer = threading.Thread(target=_knowledge_writer_loop,
+                                                 name='knowledge-writer', daemon=True)
+            _knowledge_writer.start()
+    
+    item = {'entry': entry, 'result': False, 'done': threading.Event()}
+    _knowledge_write_queue.put(item)
+    if not item['done'].wait(KNOWLEDGE_WRITE_TIMEOUT):
+        log.warning("⚠️ 等待知识写入超时（%s 秒），继续在后台写入", KNOWLEDGE_WRITE_TIMEOUT)
+        return None
+    return item['result']
+
+
+@app.route('/')
+def index():
+    """显示上传表单"""
+    return _page_response(get_index_page())
+
+@app.route('/api/device')
+def api_device():
+    """返回设备信息，供首页填充（浏览器在 TTL 内复用，不必每次打开首页都请求）"""
+    response = jsonify(get_device_info())
+    response.cache_control.private = True
+    response.cache_control.max_age = int(DEVICE_INFO_TTL)
+    return response
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """请求体超过 MAX_CONTENT_LENGTH 时返回 JSON，页面脚本可直接显示提示"""
+    return jsonify({
+        'success': False,
+        'message': f'上传内容过大，请控制在 {KB_MAX_FILE_HUMAN} 以内'
+    }), 413
 
 @app.route('/upload', methods=['POST'])
 def upload_knowledge():
     """处理知识上传"""
+    # 解析表单前先按 Content-Length 拒绝空提交和超大提交
+    content_length = request.content_length or 0
+    if content_length == 0:
+        return jsonify({
+            'success': False,
+            'message': '请至少填写一项内容'
+        }), 400
+    if content_length > config.KNOWLEDGE_FORM_MAX_BYTES:
+        return jsonify({
+            'success': False,
+            'message': f'提交内容过大，请控制在 {KNOWLEDGE_FORM_MAX_HUMAN} 以内'
+        }), 413
+    
     try:
         # 获取表单数据
-        school_info = request.form.get('school_info', '').strip()
-        history = request.form.get('history', '').strip()
-        celebrities_json = request.form.get('celebrities', '').strip()
+        form = request.form
+        values = {field: form.get(field, '').strip() for field in KNOWLEDGE_FIELDS}
+        celebrities_json = values['celebrities']
         
-        # 添加调试信息
-        print(f"接收到的数据: school_info={school_info[:50]}..., history={history[:50]}..., celebrities_json={celebrities_json[:50]}...")
+        # 添加调试信息（调试级别日志，默认不输出，也不拼接字符串）
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("接收到的数据: %s", ", ".join(f"{field}={value[:50]}..." for field, value in values.items()))
         
         # 处理校友数据：如果是JSON格式，将其转为格式化文本
         celebrities = ''
         if celebrities_json:
             try:
-                celebrities_data = json.loads(celebrities_json)
-                print(f"解析校友数据: {celebrities_data}")  # 调试信息
+                celebrities_data = app.json.loads(celebrities_json)
+                log.debug("解析校友数据: %s", celebrities_data)
                 formatted_items = []
                 if isinstance(celebrities_data, list):
                     for celeb in celebrities_data:
@@ -429,16 +1342,17 @@ def upload_knowledge():
                             elif desc:
                                 formatted_items.append(desc)
                 celebrities = "\n\n".join(formatted_items).strip()
-                print(f"处理校友数据: {celebrities[:100]}...")  # 调试信息
+                log.debug("处理校友数据: %s...", celebrities[:100])
             except json.JSONDecodeError:
                 # 如果不是JSON格式，直接使用原文本
                 celebrities = celebrities_json
-                print("非JSON格式校友数据，使用原文本")
+                log.debug("非JSON格式校友数据，使用原文本")
         else:
-            print("未接收到校友数据")  # 调试信息
+            log.debug("未接收到校友数据")
+        values['celebrities'] = celebrities  # 使用格式化文本
         
         # 检查是否有内容
-        if not school_info and not history and not celebrities:
+        if not any(values.values()):
             return jsonify({
                 'success': False,
                 'message': '请至少填写一项内容'
@@ -450,14 +1364,15 @@ def upload_knowledge():
         
         # 保存原始JSON到数据库，以便于维护结构化数据
         # 但同时存储格式化的文本版本以兼容原有的搜索功能
-        success = knowledge_manager.add_knowledge(
-            school_info=school_info,
-            history=history,
-            celebrities=celebrities,  # 使用格式化文本
-            device_id=device_id
-        )
+        success = submit_knowledge(device_id=device_id, **values)
         
-        if success:
+        if success is None:
+            return jsonify({
+                'success': True,
+                'pending': True,
+                'message': '知识已提交，正在后台保存，请稍后刷新页面查看'
+            })
+        elif success:
             # 统计信息
             stats = knowledge_manager.get_knowledge_stats()
             total = stats.get('total', 0)
@@ -474,39 +1389,270 @@ def upload_knowledge():
             })
             
     except Exception as e:
-        print(f"上传知识时出错: {e}")
+        log.exception("上传知识时出错")
         return jsonify({
             'success': False,
             'message': f'上传失败：{str(e)}'
         })
 
-@app.route('/kb/usage')
+# 知识库文件接口
+kb_bp = Blueprint('kb', __name__, url_prefix='/kb')
+
+# 最近一次生成的用量信息；已用字节数不变时直接复用，变化时整体替换（不原地修改）
+_kb_usage_cache = {
+    'used_bytes': -1,
+    'max_bytes': config.KNOWLEDGE_BASE_MAX_BYTES,
+    'used_human': '',
+    'max_human': KB_MAX_HUMAN,
+    'percent': 0.0,
+}
+
+def kb_usage_info(used_bytes):
+    """返回知识库用量信息字典，调用方不得修改返回值"""
+    global _kb_usage_cache
+    usage = _kb_usage_cache
+    if usage['used_bytes'] != used_bytes:
+        max_bytes = usage['max_bytes']
+        # 整数运算得到保留一位小数的百分比
+        percent = min(1000, used_bytes * 1000 // max_bytes) / 10 if max_bytes > 0 else 0.0
+        usage = dict(usage, used_bytes=used_bytes, used_human=format_bytes(used_bytes), percent=percent)
+        _kb_usage_cache = usage
+    return usage
+
+@kb_bp.route('/usage')
 def kb_usage():
-    """获取知识库文件使用情况"""
+    """获取知识库文件使用情况
+    
+    以已用字节数作为 ETag，浏览器每次带 If-None-Match 校验；
+    用量未变时返回 304，页面反复刷新用量时不再重复传输内容。
+    """
     try:
-        used_bytes = get_folder_size(config.KNOWLEDGE_BASE_DIR)
-        max_bytes = config.KNOWLEDGE_BASE_MAX_BYTES
-        used_human = format_bytes(used_bytes)
-        max_human = format_bytes(max_bytes)
-        percent = min(100, (used_bytes / max_bytes) * 100) if max_bytes > 0 else 0
-        
+        used_bytes = get_kb_used_bytes()
+        response = jsonify({'success': True, **kb_usage_info(used_bytes)})
+        response.set_etag(f"{used_bytes}-{config.KNOWLEDGE_BASE_MAX_BYTES}")
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    except Exception as e:
         return jsonify({
+            'success': False,
+            'message': f'获取使用情况失败: {str(e)}'
+        })
+
+# 多文件上传时并行写盘的线程数
+KB_UPLOAD_CONCURRENCY = int(os.environ.get('KB_UPLOAD_CONCURRENCY', '4'))
+_kb_save_pool = ThreadPoolExecutor(max_workers=KB_UPLOAD_CONCURRENCY, thread_name_prefix='kb-save')
+# 保存后的摘要计算和去重在此线程池中进行，响应不必等待
+_kb_post_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='kb-post')
+
+class KbFileResult:
+    """单个上传文件的保存结果（__slots__ 固定字段，多文件上传时不为每个文件建 dict）"""
+    __slots__ = ('success', 'out_of_space', 'written', 'path', 'error')
+    
+    def __init__(self, error=None):
+        self.success = False
+        self.out_of_space = False
+        self.written = 0
+        self.path = None
+        self.error = error
+
+def _save_kb_file(file, existing_names, quota, sync=True):
+    """保存单个已通过类型校验的上传文件，返回 KbFileResult"""
+    result = KbFileResult()
+    
+    # 确保文件名安全
+    filename = sanitize_filename(file.filename)
+    
+    try:
+        staged_path = _staged_upload_path(file.stream)
+        if staged_path is not None:
+            # 表单解析时已写入暂存文件，直接链接到知识库
+            file_path, written, complete = link_staged_upload(file.stream, staged_path, filename,
+                                                              existing_names, quota, sync)
+        else:
+            # 边写边统计大小，超过单文件限制或剩余空间时中止并删除；
+            # 同样先写入暂存文件，写完后再链接到知识库，写入期间不影响已用空间统计
+            fd, tmp_path = create_staging_file()
+            try:
+                written, complete = save_upload_stream(file, fd, tmp_path, quota, sync)
+                if complete:
+                    try:
+                        file_path = publish_kb_file(tmp_path, filename, existing_names, written)
+                    except Exception:
+                        quota.release(written)
+                        raise
+            finally:
+                _remove_quietly(tmp_path)
+    except Exception as e:
+        result.error = f"{filename}: 保存失败 ({str(e)})"
+        return result
+    finally:
+        file.close()  # 及时释放 Werkzeug 的临时文件
+    
+    if not complete:
+        if written > config.KNOWLEDGE_BASE_MAX_FILE_BYTES:
+            result.error = f"{filename}: 文件超过大小限制 (>{KB_MAX_FILE_HUMAN})"
+        else:
+            result.out_of_space = True
+        return result
+    
+    result.success = True
+    result.written = written
+    result.path = file_path
+    return result
+
+def _save_kb_files(accepted, existing_names, quota):
+    """依次产出各文件的保存结果；多个文件时并行写盘且不逐个 fsync，按提交顺序产出"""
+    if len(accepted) > 1:
+        return _kb_save_pool.map(lambda file: _save_kb_file(file, existing_names, quota, sync=False), accepted)
+    return (_save_kb_file(file, existing_names, quota) for file in accepted)
+
+def _finish_kb_upload(results, batch):
+    """统计保存结果并刷盘，返回响应内容
+    
+    batch 为 True 时各文件写入后未 fsync，在此一次 syncfs。
+    """
+    # 一次遍历完成统计和计数，同时收集需要刷盘的文件
+    success_count = 0
+    fail_count = 0
+    error_msgs = []
+    out_of_space = False
+    saved = []
+    
+    for result in results:
+        if result.success:
+            saved.append(result)
+            success_count += 1
+        elif result.out_of_space:
+            out_of_space = True
+        else:
+            fail_count += 1
+            error_msgs.append(result.error)
+    
+    # 已用空间已在各文件链接进知识库时累加（见 publish_kb_file），保存完成后交给后台去重
+    if KB_DEDUP:
+        for result in saved:
+            _kb_post_pool.submit(dedup_saved_file, result.path, result.written)
+    
+    saved_paths = [result.path for result in saved]
+    if batch:
+        sync_kb_files(saved_paths)
+    elif saved_paths:
+        fsync_directory(config.KNOWLEDGE_BASE_DIR)
+    
+    # 检查剩余空间
+    if out_of_space:
+        return {
+            'success': False,
+            'message': '存储空间不足，无法上传所有文件'
+        }
+    
+    # 获取更新后的使用情况（计数已累加，目录未另有变化时不会重新扫描）
+    usage_info = kb_usage_info(get_kb_used_bytes())
+    
+    # 返回结果
+    if success_count > 0:
+        message = f"成功上传 {success_count} 个文件"
+        if fail_count > 0:
+            message += f"，{fail_count} 个文件失败"
+            if error_msgs:
+                message += f"\n错误信息: {', '.join(error_msgs[:3])}"
+                if len(error_msgs) > 3:
+                    message += f"...等 {len(error_msgs)} 个错误"
+        
+        return {
             'success': True,
-            'used_bytes': used_bytes,
-            'max_bytes': max_bytes,
-            'used_human': used_human,
-            'max_human': max_human,
-            'percent': round(percent, 1)
+            'message': message,
+            'usage': usage_info
+        }
+    else:
+        return {
+            'success': False,
+            'message': f"所有文件上传失败\n{', '.join(error_msgs[:5])}"
+        }
+
+def _stream_kb_upload(results, accepted, existing_names, quota, staging_paths):
+    """NDJSON 响应：每个文件保存完成后立即输出一行结果，最后一行为汇总（内容同普通响应）
+    
+    多个文件时逐行结果在整批刷盘之前输出，汇总行表示已全部落盘。
+    生成器在请求结束后才执行，上传文件和暂存文件由它自己关闭和删除。
+    """
+    def line(obj):
+        return app.json.dumps(obj) + '\n'
+    
+    def file_line(result):
+        return line({
+            'success': result.success,
+            'name': os.path.basename(result.path) if result.path else None,
+            'out_of_space': result.out_of_space,
+            'error': result.error,
         })
+    
+    try:
+        for result in results:  # 校验时已被拒绝的文件
+            yield file_line(result)
+        for result in _save_kb_files(accepted, existing_names, quota):
+            results.append(result)
+            yield file_line(result)
+        yield line(_finish_kb_upload(results, len(accepted) > 1))
     except Exception as e:
+        log.exception("文件上传错误")
+        yield line({'success': False, 'message': f'上传失败: {str(e)}'})
+    finally:
+        for file in accepted:
+            file.close()
+        for path in staging_paths:
+            _remove_quietly(path)
+
+# 同时处理的上传请求数上限：限制并发进行的表单解析（写暂存文件）、保存和 syncfs。
+# 不限制请求体的接收缓冲：waitress 在调用视图前已收完整个请求体（较大时缓冲在临时文件中），
+# 只有 Flask 开发服务器是在获得许可后才从连接读取请求体
+KB_UPLOAD_MAX_ACTIVE = int(os.environ.get('KB_UPLOAD_MAX_ACTIVE', str(max(2, os.cpu_count() or 1))))
+KB_UPLOAD_WAIT = float(os.environ.get('KB_UPLOAD_WAIT', '10'))  # 秒，等待许可超时后返回 503
+_kb_upload_gate = threading.BoundedSemaphore(KB_UPLOAD_MAX_ACTIVE)
+
+@kb_bp.before_request
+def check_kb_upload_headers():
+    """解析请求体之前，只凭请求头拒绝无法解析或超出剩余空间的上传"""
+    if request.endpoint != KB_UPLOAD_ENDPOINT:
+        return None
+    if request.mimetype != 'multipart/form-data' or not request.mimetype_params.get('boundary'):
         return jsonify({
             'success': False,
-            'message': f'获取使用情况失败: {str(e)}'
-        })
+            'message': '没有选择文件'
+        }), 400
+    content_length = request.content_length or 0
+    # 先用一次 statvfs 检查分区剩余空间（SD 卡可能先于配额写满），再按知识库配额检查
+    fs_free = fs_free_bytes()
+    if (fs_free is not None and content_length > fs_free) or \
+            content_length > config.KNOWLEDGE_BASE_MAX_BYTES - get_kb_used_bytes():
+        return jsonify({
+            'success': False,
+            'message': '存储空间不足，无法上传所有文件'
+        }), 413
+    return None
 
-@app.route('/kb/upload', methods=['POST'])
+@kb_bp.route('/upload', methods=['POST'])
 def upload_kb_files():
-    """处理知识库文件上传"""
+    """处理知识库文件上传（限制同时进行的上传数）"""
+    if not _kb_upload_gate.acquire(timeout=KB_UPLOAD_WAIT):
+        return jsonify({
+            'success': False,
+            'message': '服务器繁忙，请稍后重试'
+        }), 503
+    
+    release = True
+    try:
+        response = app.make_response(_upload_kb_files())
+        if response.is_streamed:
+            # 流式响应在视图返回后才写盘，响应结束时再归还许可
+            response.call_on_close(_kb_upload_gate.release)
+            release = False
+        return response
+    finally:
+        if release:
+            _kb_upload_gate.release()
+
+def _upload_kb_files():
     try:
         # 检查是否有文件
         if 'files' not in request.files:
@@ -522,8 +1668,24 @@ def upload_kb_files():
                 'message': '没有选择文件'
             })
         
+        # 先做不涉及写盘的类型和文件头校验，被拒绝的文件立即释放，不进入写盘线程
+        results = []
+        accepted = []
+        for file in files:
+            if not (file and file.filename):
+                continue
+            if not is_allowed_file(file.filename):
+                file.close()
+                results.append(KbFileResult(f"{file.filename}: 不支持的文件类型"))
+                continue
+            if not is_valid_file_content(file.filename, file.stream):
+                file.close()
+                results.append(KbFileResult(f"{file.filename}: 文件内容与类型不符"))
+                continue
+            accepted.append(file)
+        
         # 检查存储空间
-        current_size = get_folder_size(config.KNOWLEDGE_BASE_DIR)
+        current_size = get_kb_used_bytes()
         if current_size >= config.KNOWLEDGE_BASE_MAX_BYTES:
             return jsonify({
                 'success': False,
@@ -533,106 +1695,153 @@ def upload_kb_files():
         # 确保目标目录存在
         os.makedirs(config.KNOWLEDGE_BASE_DIR, exist_ok=True)
         
-        # 保存文件
-        success_count = 0
-        fail_count = 0
-        error_msgs = []
+        # 已有文件名只读取一次，用于生成不重名的文件名
+        existing_names = list_existing_names(config.KNOWLEDGE_BASE_DIR)
         
-        for file in files:
-            if file and file.filename:
-                # 检查文件类型
-                if not is_allowed_file(file.filename):
-                    fail_count += 1
-                    error_msgs.append(f"{file.filename}: 不支持的文件类型")
-                    continue
-                
-                # 确保文件名安全
-                filename = sanitize_filename(file.filename)
-                unique_filename = get_unique_filename(config.KNOWLEDGE_BASE_DIR, filename)
-                
-                # 检查文件大小
-                file_content = file.read()
-                file.seek(0)  # 重置文件指针以便后续保存
-                
-                if len(file_content) > config.KNOWLEDGE_BASE_MAX_FILE_BYTES:
-                    fail_count += 1
-                    error_msgs.append(f"{filename}: 文件超过大小限制 ({format_bytes(len(file_content))})")
-                    continue
-                
-                # 检查剩余空间
-                if current_size + len(file_content) > config.KNOWLEDGE_BASE_MAX_BYTES:
-                    return jsonify({
-                        'success': False,
-                        'message': '存储空间不足，无法上传所有文件'
-                    })
-                
-                # 保存文件
-                try:
-                    file_path = os.path.join(config.KNOWLEDGE_BASE_DIR, unique_filename)
-                    file.save(file_path)
-                    current_size += len(file_content)  # 更新已用空间
-                    success_count += 1
-                except Exception as e:
-                    fail_count += 1
-                    error_msgs.append(f"{filename}: 保存失败 ({str(e)})")
+        # 并行保存文件，剩余空间由各线程共享的额度控制；
+        # 整个请求体不超过剩余空间时文件内容不可能超额，不必逐块记账
+        available = config.KNOWLEDGE_BASE_MAX_BYTES - current_size
+        if request.content_length is not None and request.content_length <= available:
+            available = None
+        quota = UploadQuota(available)
         
-        # 获取更新后的使用情况
-        usage_info = {
-            'used_bytes': get_folder_size(config.KNOWLEDGE_BASE_DIR),
-            'max_bytes': config.KNOWLEDGE_BASE_MAX_BYTES,
-            'used_human': format_bytes(get_folder_size(config.KNOWLEDGE_BASE_DIR)),
-            'max_human': format_bytes(config.KNOWLEDGE_BASE_MAX_BYTES),
-            'percent': min(100, (get_folder_size(config.KNOWLEDGE_BASE_DIR) / config.KNOWLEDGE_BASE_MAX_BYTES) * 100)
-        }
+        # 客户端接受 NDJSON 时逐个文件输出结果，否则全部完成后一次返回
+        if request.accept_mimetypes.best_match(('application/json', 'application/x-ndjson')) == 'application/x-ndjson':
+            staging_paths = request.detach_uploads()
+            return Response(_stream_kb_upload(results, accepted, existing_names, quota, staging_paths),
+                            mimetype='application/x-ndjson')
         
-        # 返回结果
-        if success_count > 0:
-            message = f"成功上传 {success_count} 个文件"
-            if fail_count > 0:
-                message += f"，{fail_count} 个文件失败"
-                if error_msgs:
-                    message += f"\n错误信息: {', '.join(error_msgs[:3])}"
-                    if len(error_msgs) > 3:
-                        message += f"...等 {len(error_msgs)} 个错误"
-            
-            return jsonify({
-                'success': True,
-                'message': message,
-                'usage': usage_info
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': f"所有文件上传失败\n{', '.join(error_msgs[:5])}"
-            })
-            
+        results.extend(_save_kb_files(accepted, existing_names, quota))
+        return jsonify(_finish_kb_upload(results, len(accepted) > 1))
+    
+    except RequestEntityTooLarge:
+        raise  # 交给 413 错误处理返回统一提示
     except Exception as e:
-        print(f"文件上传错误: {e}")
+        log.exception("文件上传错误")
         return jsonify({
             'success': False,
             'message': f'上传失败: {str(e)}'
         })
 
+app.register_blueprint(kb_bp)
+
+# 服务监听配置
+UPLOAD_SERVER_HOST = os.environ.get('UPLOAD_SERVER_HOST', '0.0.0.0')
+UPLOAD_SERVER_PORT = int(os.environ.get('UPLOAD_SERVER_PORT', '8080'))
+UPLOAD_SERVER_THREADS = int(os.environ.get('UPLOAD_SERVER_THREADS', '4'))
+UPLOAD_SERVER_KEEPALIVE = int(os.environ.get('UPLOAD_SERVER_KEEPALIVE', '30'))  # 秒
+UPLOAD_SERVER_LOOKAHEAD = int(os.environ.get('UPLOAD_SERVER_LOOKAHEAD', '16'))
+
+
+class NoDelayRequestHandler(WSGIRequestHandler):
+    """开发服务器请求处理器：关闭 Nagle 算法，小的 JSON 响应不再等待合包
+    
+    Werkzeug 开发服务器每个请求后都会关闭连接；需要 HTTP 长连接时
+    使用 waitress（默认启用长连接和 TCP_NODELAY）或 gunicorn。
+    """
+    def setup(self):
+        super().setup()
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+
+def detect_allocator():
+    """根据已加载的共享库判断是否通过 LD_PRELOAD 使用了 jemalloc / tcmalloc"""
+    try:
+        with open('/proc/self/maps', encoding='utf-8', errors='replace') as f:
+            maps = f.read()
+    except OSError:
+        return 'unknown'
+    for name in ('jemalloc', 'tcmalloc'):
+        if f'lib{name}' in maps:
+            return name
+    return 'glibc'
+
+def prime_kb_usage():
+    """启动时统计一次知识库已用空间，首个 /kb/usage 请求无需扫描目录"""
+    used_bytes = get_kb_used_bytes()
+    log.info("📦 知识库已用空间: %s / %s", format_bytes(used_bytes), KB_MAX_HUMAN)
+
+
+def create_upload_server(host=UPLOAD_SERVER_HOST, port=UPLOAD_SERVER_PORT):
+    """创建并绑定上传服务器，返回 (serve, shutdown)
+    
+    serve 打印监听地址后阻塞运行，直到 shutdown 被调用（可在其他线程中调用）。
+    默认使用 waitress 生产服务器（固定线程池 + 监听队列）；
+    设置 UPLOAD_SERVER_DEV=1 或未安装 waitress 时退回 Werkzeug 开发服务器。
+    端口无法监听时抛出 OSError。
+    """
+    if not os.environ.get('UPLOAD_SERVER_DEV'):
+        try:
+            from waitress.server import create_server
+        except ImportError:
+            log.warning("⚠️ 未安装 waitress，使用 Flask 开发服务器")
+        else:
+            server = create_server(
+                app,
+                host=host,
+                port=port,
+                threads=UPLOAD_SERVER_THREADS,
+                backlog=128,
+                channel_timeout=UPLOAD_SERVER_KEEPALIVE,  # 空闲长连接保持时间
+                # 处理请求时继续读取同一连接上的后续请求，客户端断开可及时发现
+                channel_request_lookahead=UPLOAD_SERVER_LOOKAHEAD,
+            )
+            
+            def serve():
+                server.print_listen("Serving on http://{}:{}")
+                server.run()
+            
+            def shutdown():
+                server.close()  # 关闭监听和唤醒管道，run() 的事件循环随之结束
+                server.task_dispatcher.shutdown()
+            
+            return serve, shutdown
+    
+    try:
+        server = make_server(host, port, app, threaded=True, request_handler=NoDelayRequestHandler)
+    except SystemExit:
+        # Werkzeug 监听失败时打印原因后直接 sys.exit，在本进程内运行时不能让宿主程序退出
+        raise OSError(f"无法监听 {host}:{port}") from None
+    server.timeout = 0.5  # handle_request 最长等待时间，即 shutdown 后最迟多久退出
+    stopping = threading.Event()
+    
+    # 不用 serve_forever/shutdown：serve 尚未开始时调用 shutdown 会一直等待
+    def serve():
+        try:
+            if not stopping.is_set():
+                server.log_startup()
+            while not stopping.is_set():
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    
+    def shutdown():
+        stopping.set()
+    
+    return serve, shutdown
+
+
+def run_server(host=UPLOAD_SERVER_HOST, port=UPLOAD_SERVER_PORT):
+    """启动上传服务（阻塞运行），多进程部署可直接使用 gunicorn，见 README"""
+    prime_kb_usage()
+    serve, _ = create_upload_server(host, port)
+    serve()
+
+
 if __name__ == '__main__':
     # 获取实际的IP地址
-    try:
-        # 获取当前IP地址
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        actual_ip = s.getsockname()[0]
-        s.close()
-    except:
-        actual_ip = "192.168.10.1"  # 默认值
-    
-    print("🚀 启动知识库上传服务器...")
-    print("📱 请用手机连接热点：OrangePi-Knowledge")
-    print(f"🔗 然后访问：http://{actual_ip}:8080")
-    print("=" * 50)
-    
-    # 启动Flask服务器
-    app.run(
-        host='0.0.0.0',  # 监听所有接口
-        port=8080,       # 使用8080端口
-        debug=False,     # 生产模式
-        threaded=True    # 支持多线程
-    )
\ No newline at end of file
+    # 获取当前IP地址
+    actual_ip = get_local_ip() or "192.168.10.1"  # 默认值
+    
+    log.info("🚀 启动知识库上传服务器...")
+    log.info("📱 请用手机连接热点：OrangePi-Knowledge")
+    log.info("🔗 然后访问：http://%s:%d", actual_ip, UPLOAD_SERVER_PORT)
+    log.info("🧠 内存分配器: %s", detect_allocator())
+    log.info("=" * 50)
+    
+    run_server()
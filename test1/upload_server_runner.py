@@ -2,51 +2,206 @@
 import os
 import sys
 import time
+import errno
+import select
 import socket
 import signal
+import struct
 import atexit
+import tempfile
+import threading
 import subprocess
 from pathlib import Path
 from typing import Optional, Tuple
 
+try:
+    import fcntl
+except ImportError:  # Windows 无 fcntl，退回端口探测
+    fcntl = None
+
 _DEFAULT_HOST = "0.0.0.0"
 _DEFAULT_PORT = int(os.environ.get("UPLOAD_SERVER_PORT", "8080"))
+# 本机探测用数字地址，connect_ex 不经过 getaddrinfo/NSS 解析
+_LOOPBACK = "127.0.0.1"
+# 设为 1 时在本进程的后台线程中运行上传服务，省去启动新解释器
+_DEFAULT_IN_PROCESS = os.environ.get("UPLOAD_SERVER_IN_PROCESS") == "1"
 
 _proc: Optional[subprocess.Popen] = None
+_server_shutdown = None  # 本进程内运行时停止服务器的函数
 _started: bool = False
 _server_url: str = ""
+_lock_fd: Optional[int] = None  # 单实例锁文件描述符，服务运行期间一直持有
+
+# 与本文件同目录的 upload_server.py，导入时解析并检查一次
+_SCRIPT_PATH: Path = Path(__file__).with_name("upload_server.py")
+_SCRIPT_EXISTS: bool = _SCRIPT_PATH.is_file()
+
+# connect_ex 返回这些错误码表示连接仍在进行中
+_CONNECT_PENDING = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+                    getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)}
+
+# 探测连上后以 RST 关闭，不在本机留下 TIME_WAIT 连接
+_LINGER_RESET = struct.pack("ii", 1, 0)
 
-def _script_path() -> Path:
-    # 与本文件同目录的 upload_server.py
-    return Path(__file__).with_name("upload_server.py")
+def _try_connect(host: str, port: int, wait: float) -> bool:
+    """非阻塞连接一次，最多等待 wait 秒，连上返回 True
 
-def _is_port_open(host: str, port: int) -> bool:
+    端口未开放时本机内核立即回 RST，connect_ex 直接返回 ECONNREFUSED，不经过 select。
+    """
     try:
-        with socket.create_connection((host, port), timeout=0.5):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setblocking(False)
+            err = s.connect_ex((host, port))
+            if err in _CONNECT_PENDING:
+                _, writable, _ = select.select([], [s], [], wait)
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) if writable else errno.ETIMEDOUT
+            if err == 0:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+            return err == 0
+    except OSError:
+        return False  # 如文件描述符耗尽，按未连上处理
+
+def _wait_for_port(host: str, port: int, timeout: float = 8.0,
+                   proc: Optional[subprocess.Popen] = None,
+                   ready: Optional[threading.Event] = None) -> bool:
+    """等待端口开放：探测间隔从 5ms 起倍增，最长 100ms，服务很快就绪时几乎不必等待
+
+    传入 proc 时，子进程已退出（启动失败）则不再等待，立即返回 False。
+    传入 ready 时，两次探测之间改为等待该事件，子进程打印监听日志后立即返回 True。
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if _try_connect(host, port, min(delay, remaining)):
             return True
-    except Exception:
+        if proc is not None and proc.poll() is not None:
+            return False
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if ready is None:
+            time.sleep(min(delay, remaining))
+        elif ready.wait(min(delay, remaining)):
+            return True
+        delay = min(delay * 2, 0.1)
+
+def _acquire_instance_lock(port: int) -> bool:
+    """获取该端口的单实例锁，已被其他进程持有时返回 False
+
+    锁随描述符关闭（包括本进程崩溃）自动释放；子进程不继承该描述符。
+    无 fcntl 或无法创建锁文件时返回 True，由调用方继续用端口探测判断。
+    """
+    global _lock_fd
+    if fcntl is None or _lock_fd is not None:
+        return True
+    path = os.path.join(tempfile.gettempdir(), f"upload_server-{port}.lock")
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    except OSError:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
         return False
+    _lock_fd = fd
+    return True
 
-def _wait_for_port(host: str, port: int, timeout: float = 8.0) -> bool:
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        if _is_port_open(host, port):
-            return True
-        time.sleep(0.2)
-    return False
+def _release_lock(fd: Optional[int]) -> None:
+    if fd is not None:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def _release_instance_lock() -> None:
+    global _lock_fd
+    fd, _lock_fd = _lock_fd, None
+    _release_lock(fd)
+
+_PIPE_READ_SIZE = 65536
+# 端口绑定完成后服务器打印的日志（werkzeug / waitress）
+_LISTEN_BANNERS = (b"Running on http", b"Serving on http")
+_BANNER_TAIL = max(len(b) for b in _LISTEN_BANNERS) - 1
+
+def _pump_output(stream, ready: Optional[threading.Event] = None) -> None:
+    """把子进程输出转发到本进程 stdout，避免管道写满后子进程阻塞在 write()
+
+    按块读取管道中已有的全部数据（os.read 有多少返回多少），整块原样写出，
+    不在父进程里逐行拆分和解码。传入 ready 时，看到监听日志即设置该事件。
+    """
+    fd = stream.fileno()
+    out = getattr(sys.stdout, "buffer", None)
+    tail = b""  # 保留上一块末尾，日志被拆在两块之间时也能匹配
+    try:
+        while True:
+            data = os.read(fd, _PIPE_READ_SIZE)
+            if not data:
+                break
+            if ready is not None and not ready.is_set():
+                window = tail + data
+                if any(b in window for b in _LISTEN_BANNERS):
+                    ready.set()
+                tail = window[-_BANNER_TAIL:]
+            try:
+                if out is not None:
+                    out.write(data)
+                else:
+                    sys.stdout.write(data.decode("utf-8", errors="replace"))
+                sys.stdout.flush()
+            except Exception:
+                pass  # 本进程 stdout 不可用时丢弃，仍继续读取
+    except (OSError, ValueError):
+        pass  # 管道已关闭
+    finally:
+        stream.close()
+
+def _serve_in_process(upload_server, serve) -> None:
+    """后台线程：与 run_server 一样先统计知识库已用空间，再开始处理请求"""
+    try:
+        upload_server.prime_kb_usage()
+    except Exception as e:
+        print(f"⚠️ 统计知识库已用空间失败: {e}")
+    serve()
+
+def _start_in_process(host: str, port: int) -> bool:
+    """在后台守护线程中运行上传服务（与独立运行时相同的服务器和配置），成功返回 True"""
+    global _server_shutdown
+    try:
+        import upload_server
+    except Exception as e:
+        print(f"⚠️ 无法在本进程内加载上传服务，改用子进程: {e}")
+        return False
+    try:
+        serve, _server_shutdown = upload_server.create_upload_server(host, port)
+    except OSError as e:
+        print(f"⚠️ 无法在本进程内监听端口 {port}，改用子进程: {e}")
+        return False
+    threading.Thread(target=_serve_in_process, args=(upload_server, serve),
+                     name="upload-server", daemon=True).start()
+    return True
 
 def ensure_upload_server_running(host: str = _DEFAULT_HOST,
                                  port: int = _DEFAULT_PORT,
-                                 project_root: Optional[Path] = None) -> Tuple[Optional[subprocess.Popen], str]:
+                                 project_root: Optional[Path] = None,
+                                 in_process: bool = _DEFAULT_IN_PROCESS) -> Tuple[Optional[subprocess.Popen], str]:
     """
     确保上传服务在运行。
-    - 若端口已被占用，视为已有实例在运行，不再拉起，只返回 URL。
+    - 若单实例锁已被其他进程持有，或端口已被占用，视为已有实例在运行，不再拉起，只返回 URL。
     - 若未运行，则启动 test1/upload_server.py 并返回 Popen 句柄与 URL。
+    - in_process 为 True 时改为在本进程后台线程中运行（返回的句柄为 None）；
+      知识库目录等相对路径以工作目录为准，工作目录不是脚本所在目录时仍启动子进程。
     """
     global _proc, _started, _server_url
 
-    script = _script_path()
-    if not script.exists():
+    if _server_shutdown is not None:
+        return None, _server_url
+
+    script = _SCRIPT_PATH
+    if not _SCRIPT_EXISTS:
         print(f"⚠️ 未找到上传服务脚本: {script}")
         return None, ""
 
@@ -54,23 +209,34 @@ def ensure_upload_server_running(host: str = _DEFAULT_HOST,
     display_host = _detect_ip_for_display() or "127.0.0.1"
     _server_url = f"http://{display_host}:{port}"
 
-    # 如果端口已开放，直接返回
-    if _is_port_open("127.0.0.1", port):
+    # 先取单实例锁：取到才由本进程拉起，避免探测端口与子进程绑定端口之间的竞争
+    if not _acquire_instance_lock(port):
+        print(f"📎 上传服务已由其他进程启动: {_server_url}")
+        return None, _server_url
+
+    # 手动启动的实例不持有锁，仍探测一次端口（本机连接，一次非阻塞探测即可得知）
+    if _try_connect(_LOOPBACK, port, 0.05):
+        _release_instance_lock()
         print(f"📎 上传服务已在运行: {_server_url}")
         return None, _server_url
 
+    if in_process:
+        if Path.cwd().resolve() != script.parent.resolve():
+            print(f"⚠️ 工作目录不是 {script.parent}，上传服务改用子进程启动")
+        elif _start_in_process(host, port):
+            print(f"🚀 已在本进程内启动上传服务: {_server_url}")
+            atexit.register(stop_upload_server)
+            return None, _server_url
+
     # 启动子进程（工作目录设为脚本目录，保证静态/模板路径可用）
-    env = os.environ.copy()
-    env.setdefault("PYTHONUNBUFFERED", "1")
+    # 已设置 PYTHONUNBUFFERED 时直接继承父进程环境，不再复制一份
+    env = None if "PYTHONUNBUFFERED" in os.environ else {**os.environ, "PYTHONUNBUFFERED": "1"}
     cmd = [sys.executable, "-u", str(script)]
 
     cwd = str(script.parent)
     creationflags = 0
-    preexec_fn = None
     if os.name == "nt":
         creationflags = subprocess.CREATE_NEW_PROCESS_GROUP  # noqa: attr-defined
-    else:
-        preexec_fn = os.setsid  # 将子进程置于新会话，便于回收
 
     try:
         _proc = subprocess.Popen(
@@ -79,16 +245,26 @@ def ensure_upload_server_running(host: str = _DEFAULT_HOST,
             env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+            bufsize=_PIPE_READ_SIZE,
             creationflags=creationflags,
-            preexec_fn=preexec_fn,
+            # 将子进程置于新会话，便于回收；不用 preexec_fn，
+            # CPython 才能用 vfork 启动，不必复制主程序（已加载模型）的页表
+            start_new_session=os.name != "nt",
         )
         _started = True
 
+        # 持续读取子进程输出（守护线程，子进程退出后自然结束），
+        # 看到监听日志即通知下方的等待立即返回
+        ready = threading.Event()
+        threading.Thread(target=_pump_output, args=(_proc.stdout, ready),
+                         name="upload-server-output", daemon=True).start()
+
         # 稍等端口开放
-        if _wait_for_port("127.0.0.1", port, timeout=10.0):
+        if _wait_for_port(_LOOPBACK, port, timeout=10.0, proc=_proc, ready=ready):
             print(f"🚀 已启动上传服务: {_server_url}")
+        elif _proc.poll() is not None:
+            _release_instance_lock()
+            print(f"⚠️ 上传服务进程已退出（返回码 {_proc.returncode}），请检查 upload_server.py 日志。")
         else:
             print("⚠️ 上传服务启动超时（端口未开放），请检查 upload_server.py 日志。")
 
@@ -97,40 +273,85 @@ def ensure_upload_server_running(host: str = _DEFAULT_HOST,
         return _proc, _server_url
     except Exception as e:
         print(f"❌ 启动上传服务失败: {e}")
+        _release_instance_lock()
         _proc = None
         _started = False
         return None, _server_url
 
-def stop_upload_server():
-    """在应用退出时尝试停止我们自己拉起的上传服务。"""
-    global _proc, _started
-    if not _started or not _proc:
-        return
+def _request_stop(proc: subprocess.Popen) -> None:
+    """向子进程发送温和的结束信号，不等待其退出"""
+    if os.name == "nt":
+        proc.send_signal(signal.CTRL_BREAK_EVENT)
+    else:
+        try:
+            os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+        except Exception:
+            proc.terminate()
+
+def _reap(proc: subprocess.Popen, timeout: float, lock_fd: Optional[int] = None) -> None:
+    """等待子进程退出（退出即返回），超时后强制结束，最后释放单实例锁"""
     try:
-        if _proc.poll() is None:
-            if os.name == "nt":
-                _proc.send_signal(signal.CTRL_BREAK_EVENT)  # 优先温和结束
-                time.sleep(0.5)
-                _proc.terminate()
-            else:
-                try:
-                    os.killpg(os.getpgid(_proc.pid), signal.SIGTERM)
-                except Exception:
-                    _proc.terminate()
-            _proc.wait(timeout=3)
+        proc.wait(timeout=timeout)
     except Exception:
         try:
-            _proc.kill()
+            proc.kill()
+            proc.wait(timeout=1)
         except Exception:
             pass
-    finally:
-        _proc = None
-        _started = False
+    _release_lock(lock_fd)
+
+_reaper: Optional[threading.Thread] = None
+
+def stop_upload_server(wait: bool = True, timeout: float = 3.0) -> None:
+    """在应用退出时尝试停止我们自己拉起的上传服务。
+
+    wait 为 False 时发出结束信号后立即返回，由后台线程等待并在超时后强制结束；
+    之后（如 atexit 时）再次调用会等待该线程完成。
+    """
+    global _proc, _started, _server_shutdown, _reaper, _lock_fd
+    if _server_shutdown is not None:
+        try:
+            _server_shutdown()
+        except Exception:
+            pass
+        finally:
+            _server_shutdown = None
+            _release_instance_lock()
+    if not _started or not _proc:
+        if wait and _reaper is not None:
+            _reaper.join(timeout)
+        return
+    proc, lock_fd = _proc, _lock_fd
+    _proc, _lock_fd = None, None
+    _started = False
+    try:
+        if proc.poll() is None:
+            _request_stop(proc)
+    except Exception:
+        pass
+    if wait:
+        _reap(proc, timeout, lock_fd)
+    else:
+        _reaper = threading.Thread(target=_reap, args=(proc, timeout, lock_fd),
+                                   name="upload-server-reaper", daemon=True)
+        _reaper.start()
+
+_IP_CACHE_TTL = 30.0  # 秒
+_ip_cache: Tuple[float, Optional[str]] = (0.0, None)
 
 def _detect_ip_for_display() -> Optional[str]:
+    """本机IP（用于显示），结果缓存 _IP_CACHE_TTL 秒"""
+    global _ip_cache
+    checked_at, ip = _ip_cache
+    now = time.monotonic()
+    if checked_at and now - checked_at < _IP_CACHE_TTL:
+        return ip
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(0.2)
             s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
+            ip = s.getsockname()[0]
     except Exception:
-        return None
+        ip = None
+    _ip_cache = (now, ip)
+    return ip